@@ -0,0 +1,195 @@
+#!/usr/bin/env python2
+'''
+Online backups of the live database, safe to run from cron while the API is
+serving. Usage:
+
+    ./backup.py                       full snapshot into backups/
+    python3 backup.py --incremental   only the pages changed since the last full one
+    ./backup.py --restore SNAP DEST   rebuild a database from a snapshot or delta
+
+Under Python 3, snapshots are taken with SQLite's online backup API a batch
+of pages at a time, sleeping between batches so writers are never starved.
+Python 2's sqlite3 doesn't expose that API, so there snapshots fall back to
+VACUUM INTO: just as consistent, and in WAL mode it doesn't block writers,
+but it copies in a single pass and rewrites the page layout as it goes.
+Deltas of such a copy would be nearly as big as the whole file, so
+incremental backups need Python 3.
+
+Every snapshot passes an integrity check before it is renamed into place,
+old ones are rotated out along with their deltas, and each full snapshot
+keeps only its newest deltas.
+'''
+from __future__ import print_function
+
+import argparse
+import contextlib
+import glob
+import gzip
+import json
+import os, os.path
+import shutil
+import struct
+import time
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+DB_FILE = 'idealab.db'
+DB_PATH = THIS_DIR + '/' + DB_FILE
+BACKUP_DIR = THIS_DIR + '/backups'
+PAGES = 256     # Pages copied per step of the backup
+SLEEP = 0.05    # Seconds to sleep between steps
+KEEP = 7        # Full snapshots to retain
+KEEP_DELTAS = 24    # Deltas to retain per full snapshot
+
+def check(path):
+    with contextlib.closing(sqlite3.connect(path)) as db:
+        result = db.execute('PRAGMA integrity_check').fetchone()[0]
+    if result != 'ok':
+        raise RuntimeError('Integrity check of {} failed: {}'.format(path, result))
+
+def snapshot(dest, src=DB_PATH, pages=PAGES, sleep=SLEEP):
+    '''
+    Copy a consistent image of the database at src to dest
+    '''
+    tmp = dest + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    with contextlib.closing(sqlite3.connect(src, timeout=30)) as db:
+        if hasattr(db, 'backup'):
+            with contextlib.closing(sqlite3.connect(tmp)) as target:
+                db.backup(target, pages=pages, sleep=sleep)
+        else:
+            db.execute('VACUUM INTO ?', (tmp,))
+    check(tmp)
+    os.rename(tmp, dest)
+    return dest
+
+def page_size(path):
+    with contextlib.closing(sqlite3.connect(path)) as db:
+        return db.execute('PRAGMA page_size').fetchone()[0]
+
+def pages(path, size):
+    with open(path, 'rb') as file:
+        while True:
+            page = file.read(size)
+            if not page:
+                return
+            yield page
+
+def delta(base, new, dest):
+    '''
+    Write the pages of new which differ from base to a gzipped delta file
+    '''
+    size = page_size(new)
+    header = {
+        'base': os.path.basename(base),
+        'page_size': size,
+        'pages': os.path.getsize(new) // size,
+    }
+    changed = 0
+    with gzip.open(dest + '.tmp', 'wb') as out:
+        out.write((json.dumps(header) + '\n').encode('utf8'))
+        base_pages = pages(base, size)
+        for number, page in enumerate(pages(new, size)):
+            if next(base_pages, None) != page:
+                out.write(struct.pack('>I', number) + page)
+                changed += 1
+    os.rename(dest + '.tmp', dest)
+    return changed
+
+def restore(snap, dest):
+    '''
+    Rebuild a database at dest from a full snapshot or a delta and its base
+    '''
+    if not snap.endswith('.delta'):
+        shutil.copy(snap, dest)
+        check(dest)
+        return dest
+    with gzip.open(snap, 'rb') as file:
+        header = json.loads(file.readline().decode('utf8'))
+        shutil.copy(os.path.join(os.path.dirname(snap), header['base']), dest + '.tmp')
+        size = header['page_size']
+        with open(dest + '.tmp', 'r+b') as out:
+            while True:
+                number = file.read(4)
+                if not number:
+                    break
+                out.seek(struct.unpack('>I', number)[0] * size)
+                out.write(file.read(size))
+            out.truncate(header['pages'] * size)
+    check(dest + '.tmp')
+    os.rename(dest + '.tmp', dest)
+    return dest
+
+def full_snapshots(path):
+    return sorted(f for f in glob.glob(path + '/' + DB_FILE + '.*')
+                  if not f.endswith(('.delta', '.new', '.tmp')))
+
+def rotate(path=BACKUP_DIR, keep=KEEP, keep_deltas=KEEP_DELTAS):
+    '''
+    Keep the newest full snapshots, and only the newest keep_deltas deltas
+    of each of them
+    '''
+    full = full_snapshots(path)
+    for f in full[:-keep]:
+        os.remove(f)
+    kept = dict((os.path.basename(f), []) for f in full[-keep:])
+    for f in sorted(glob.glob(path + '/' + DB_FILE + '.*.delta')):
+        with gzip.open(f, 'rb') as file:
+            base = json.loads(file.readline().decode('utf8'))['base']
+        if base in kept:
+            kept[base].append(f)
+        else:
+            os.remove(f)
+    for deltas in kept.values():
+        for f in deltas[:-keep_deltas] if keep_deltas else deltas:
+            os.remove(f)
+
+def backup(path=BACKUP_DIR, incremental=False, keep=KEEP, keep_deltas=KEEP_DELTAS):
+    '''
+    Take a snapshot (or a delta against the newest full one) into path, then
+    rotate. Returns the path of the new file.
+    '''
+    if incremental and not hasattr(sqlite3.Connection, 'backup'):
+        raise RuntimeError('Incremental backups need Python 3 (python3 backup.py --incremental)')
+    try:
+        os.mkdir(path)
+    except OSError: pass
+    dest = '%s/%s.%s' % (path, DB_FILE, time.strftime('%F@%R'))
+    full = full_snapshots(path)
+    if incremental and full:
+        snapshot(dest + '.new')
+        try:
+            delta(full[-1], dest + '.new', dest + '.delta')
+        finally:
+            os.remove(dest + '.new')
+        dest += '.delta'
+    else:
+        snapshot(dest)
+    rotate(path, keep, keep_deltas)
+    return dest
+
+def main():
+    parser = argparse.ArgumentParser(description='Back up the idealab database')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only store the pages changed since the last full snapshot')
+    parser.add_argument('--keep', type=int, default=KEEP,
+                        help='number of full snapshots to retain')
+    parser.add_argument('--keep-deltas', type=int, default=KEEP_DELTAS,
+                        help='number of deltas to retain per full snapshot')
+    parser.add_argument('--restore', nargs=2, metavar=('SNAPSHOT', 'DEST'),
+                        help='rebuild a database from a snapshot or delta')
+    args = parser.parse_args()
+    if args.restore:
+        print(restore(*args.restore))
+    else:
+        try:
+            print(backup(incremental=args.incremental, keep=args.keep, keep_deltas=args.keep_deltas))
+        except RuntimeError as e:
+            parser.error(str(e))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python2
+'''
+Run parallel readers and writers against a throwaway copy of the database,
+once with the configured SQLITE_PRAGMAS and pool and once with SQLite's
+defaults, and report the throughput and lock errors of each. Usage:
+
+    bench/concurrency.py [--readers 4] [--writers 4] [--seconds 10] [--ideas 2000]
+'''
+import argparse
+import json
+import multiprocessing
+import os.path
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import synthetic
+
+USERS = 200
+
+def worker(kind, deadline, ideas, results):
+    import idealab
+    from flask.ext.login import login_user
+    from sqlalchemy.exc import OperationalError
+    ops = errors = 0
+    while time.time() < deadline:
+        user = idealab.User.query.get(random.randint(1, USERS))
+        idea_id = random.randint(1, ideas)
+        try:
+            if kind == 'reader':
+                with idealab.app.test_request_context('/ideas?limit=50&sort=-votes'):
+                    login_user(user)
+                    response, code = idealab.get_ideas()
+            else:
+                with idealab.app.test_request_context('/love/idea/%d' % idea_id, method='PUT'):
+                    login_user(user)
+                    response, code = idealab.toggle_love(idea_id)
+            ops += 1
+        except OperationalError:
+            idealab.db.session.rollback()
+            errors += 1
+    results.put((kind, ops, errors))
+
+def run(tuned, args):
+    '''
+    Measure one configuration, in a process of its own since it has to be
+    set up before idealab is imported
+    '''
+    tmp = tempfile.mkdtemp()
+    try:
+        settings = {} if tuned else {'SQLALCHEMY_POOL_SIZE': 0, 'SQLITE_PRAGMAS': []}
+        idealab = synthetic.load(os.path.join(tmp, 'idealab.db'), **settings)
+        synthetic.seed(idealab, args.ideas, USERS)
+
+        results = multiprocessing.Queue()
+        deadline = time.time() + args.seconds
+        procs = [multiprocessing.Process(target=worker, args=(kind, deadline, args.ideas, results))
+                 for kind in ['reader'] * args.readers + ['writer'] * args.writers]
+        for p in procs:
+            p.start()
+        totals = {'reader': [0, 0], 'writer': [0, 0]}
+        for p in procs:
+            kind, ops, errors = results.get()
+            totals[kind][0] += ops
+            totals[kind][1] += errors
+        for p in procs:
+            p.join()
+        print(json.dumps({
+            'reads/s': totals['reader'][0] / float(args.seconds),
+            'writes/s': totals['writer'][0] / float(args.seconds),
+            'errors': totals['reader'][1] + totals['writer'][1],
+        }))
+    finally:
+        shutil.rmtree(tmp)
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent read/write throughput')
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--seconds', type=int, default=10)
+    parser.add_argument('--ideas', type=int, default=2000)
+    parser.add_argument('--run', choices=['tuned', 'default'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        return run(args.run == 'tuned', args)
+
+    print('%-8s %10s %10s %8s' % ('', 'reads/s', 'writes/s', 'errors'))
+    for mode in 'tuned', 'default':
+        output = subprocess.check_output([sys.executable] + sys.argv + ['--run', mode])
+        result = json.loads(output.strip().splitlines()[-1])
+        print('%-8s %10.1f %10.1f %8d' % (mode, result['reads/s'], result['writes/s'], result['errors']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python2
+'''
+Latency, throughput and queries per request of the API's hot endpoints
+against a synthetic database, compared with a stored baseline. Usage:
+
+    bench/endpoints.py [--ideas 2000] [--users 200] [--votes 20000] [--requests 200]
+    bench/endpoints.py --http [--procs 4] [--seconds 10]
+    bench/endpoints.py --save           # make these results the baseline
+
+By default requests go one at a time through Flask's test client in this
+process, which is where queries per request are counted (streamed bodies
+included). With --http a local server is started on the database and
+several processes load each endpoint over HTTP at once.
+'''
+import argparse
+import cookielib
+import json
+import multiprocessing
+import os, os.path
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+import synthetic
+
+BASELINE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'baseline.json')
+ADMIN, USER, ANONYMOUS = 1, 2, None
+
+# Name, method, path (filled with a random published idea) and who asks
+ENDPOINTS = [
+    ('/ideas',                  'GET', '/ideas',                                USER),
+    ('/ideas (anonymous)',      'GET', '/ideas',                                ANONYMOUS),
+    ('/ideas (index, compact)', 'GET', '/ideas?fields=id,title,slug,votes&compact=1', USER),
+    ('/ideas/<id>',             'GET', '/ideas/{idea}',                         USER),
+    ('/ideas/top',              'GET', '/ideas/top?n=20',                       USER),
+    ('/ideas/top (trending)',   'GET', '/ideas/top?n=20&window=week',           USER),
+    ('/love/idea/<id>',         'PUT', '/love/idea/{idea}',                     USER),
+    ('/me',                     'GET', '/me',                                   USER),
+    ('published_ideas.csv',     'GET', '/export/published_ideas.csv',           ADMIN),
+    ('published_improvements.csv', 'GET', '/export/published_improvements.csv', ADMIN),
+]
+
+queries = [0]
+
+def instrument(idealab):
+    '''
+    Add a login route for the benchmark's users and count every query
+    '''
+    from flask.ext.login import login_user
+
+    @idealab.app.route('/__bench/login/<int:id>')
+    def bench_login(id):
+        login_user(idealab.User.query.get(id))
+        return 'ok'
+
+    @idealab.db.event.listens_for(idealab.db.engine, 'before_cursor_execute')
+    def count_query(*a):
+        queries[0] += 1
+
+def percentile(times, p):
+    return times[int(round(p / 100.0 * (len(times) - 1)))]
+
+def summarize(times, seconds, count=None):
+    times = sorted(times)
+    return {
+        'p50': percentile(times, 50) * 1000,
+        'p95': percentile(times, 95) * 1000,
+        'p99': percentile(times, 99) * 1000,
+        'rps': len(times) / seconds,
+        'queries': count,
+    }
+
+def run_in_process(idealab, ideas, args):
+    root = idealab.APPLICATION_ROOT
+    clients = {}
+    for user in ADMIN, USER, ANONYMOUS:
+        clients[user] = idealab.app.test_client()
+        if user:
+            clients[user].get(root + '/__bench/login/%d' % user)
+    results = {}
+    for name, method, path, user in ENDPOINTS:
+        client, times = clients[user], []
+        for n in range(args.warmup + args.requests):
+            url = root + path.format(idea=random.choice(ideas))
+            if n == args.warmup:
+                start_queries = queries[0]
+            start = time.time()
+            response = client.open(url, method=method)
+            response.get_data()
+            times.append(time.time() - start)
+            assert response.status_code == 200, (url, response.status_code)
+        times = times[args.warmup:]
+        results[name] = summarize(times, sum(times),
+                                  (queries[0] - start_queries) / float(args.requests))
+    return results
+
+def http_worker(task):
+    base, method, path, user, ideas, deadline = task
+    opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cookielib.CookieJar()))
+    if user:
+        opener.open(base + '/__bench/login/%d' % user).read()
+    times = []
+    while time.time() < deadline:
+        request = urllib2.Request(base + path.format(idea=random.choice(ideas)))
+        request.get_method = lambda: method
+        start = time.time()
+        try:
+            opener.open(request).read()
+        except urllib2.HTTPError as e:
+            raise RuntimeError('%s %s' % (e.code, request.get_full_url()))
+        times.append(time.time() - start)
+    return times
+
+def run_http(ideas, args, path):
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    server = subprocess.Popen([sys.executable, __file__, '--serve', str(port), path]
+                              + (['--write-behind'] if args.write_behind else []))
+    try:
+        import config
+        base = 'http://127.0.0.1:%d%s' % (port, config.APPLICATION_ROOT)
+        for attempt in range(100):
+            try:
+                urllib2.urlopen(base + '/me')
+            except urllib2.HTTPError:
+                break
+            except urllib2.URLError:
+                time.sleep(0.1)
+        pool = multiprocessing.Pool(args.procs)
+        results = {}
+        for name, method, endpoint, user in ENDPOINTS:
+            deadline = time.time() + args.seconds
+            task = (base, method, endpoint, user, ideas, deadline)
+            times = sum(pool.map(http_worker, [task] * args.procs), [])
+            results[name] = summarize(times, args.seconds)
+        pool.close()
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+def serve(port, path, write_behind):
+    idealab = synthetic.load(path, **settings(write_behind, path))
+    instrument(idealab)
+    idealab.app.run(host='127.0.0.1', port=port, threaded=True)
+
+def settings(write_behind, path):
+    if not write_behind:
+        return {}
+    return {'LOVE_WRITE_BEHIND': True, 'LOVE_JOURNAL': path + '.love'}
+
+def change(old, new):
+    if not old or new is None:
+        return ''
+    return '%+.0f%%' % ((new - old) * 100.0 / old)
+
+def report(results, baseline):
+    print('%-28s %9s %9s %9s %9s %8s  %s' % (
+        '', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'queries', 'vs baseline (p95, req/s)'))
+    for name, method, path, user in ENDPOINTS:
+        r, b = results[name], baseline.get(name, {})
+        print('%-28s %9.2f %9.2f %9.2f %9.1f %8s  %s' % (
+            name, r['p50'], r['p95'], r['p99'], r['rps'],
+            '-' if r['queries'] is None else '%.1f' % r['queries'],
+            ' '.join(filter(None, [change(b.get('p95'), r['p95']), change(b.get('rps'), r['rps'])]))))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the hot API endpoints')
+    parser.add_argument('--ideas', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--votes', type=int, default=20000)
+    parser.add_argument('--improvements', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per endpoint in process')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--http', action='store_true',
+                        help='load a local server over HTTP from several processes')
+    parser.add_argument('--procs', type=int, default=4)
+    parser.add_argument('--seconds', type=int, default=10,
+                        help='seconds per endpoint over HTTP')
+    parser.add_argument('--write-behind', action='store_true',
+                        help='buffer love toggles (LOVE_WRITE_BEHIND)')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true',
+                        help='store these results as the baseline')
+    parser.add_argument('--serve', nargs=2, metavar=('PORT', 'DB'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        return serve(int(args.serve[0]), args.serve[1], args.write_behind)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'idealab.db')
+        idealab = synthetic.load(path, **settings(args.write_behind, path))
+        synthetic.seed(idealab, args.ideas, args.users, args.votes, args.improvements)
+        ideas = [id for id, in idealab.db.session.query(idealab.Idea.id)
+                                                 .filter(idealab.Idea.published==True)]
+        idealab.db.session.remove()
+        if args.http:
+            results = run_http(ideas, args, path)
+        else:
+            instrument(idealab)
+            results = run_in_process(idealab, ideas, args)
+    finally:
+        shutil.rmtree(tmp)
+
+    scale = {name: getattr(args, name) for name in
+             ('ideas', 'users', 'votes', 'improvements', 'http', 'procs', 'write_behind')}
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get('settings') != scale:
+            print('Baseline was taken with different settings: %s' % baseline.get('settings'))
+    report(results, baseline.get('results', {}))
+    if args.save:
+        with open(args.baseline, 'w') as file:
+            json.dump({'settings': scale, 'results': results}, file, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
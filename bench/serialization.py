@@ -0,0 +1,125 @@
+#!/usr/bin/env python2
+'''
+Check that the column-only serializer (serialize() over
+Model.serial_query()) produces exactly the JSON of the serialized
+properties, for every row of a synthetic database seasoned with awkward
+ones, as each kind of viewer and through the paginated API. Then time
+both paths. Exits non-zero on any difference. Usage:
+
+    bench/serialization.py [--ideas 2000] [--improvements 500] [--tz America/New_York]
+'''
+import argparse
+import datetime
+import json
+import os, os.path
+import shutil
+import sys
+import tempfile
+import time
+import synthetic
+
+def awkward(idealab):
+    '''
+    Rows that exercise the edge cases of the serialized properties: dates
+    around DST changes and before 1900, missing titles, anonymous
+    and @handle contributors, and improvements without a user
+    '''
+    Idea, Improvement = idealab.Idea, idealab.Improvement
+    # (Not the hour repeated when DST ends: strftime('%s') and mktime both
+    # resolve it from whatever the previous call left behind in libc.)
+    dates = [datetime.datetime(2015, 3, 8, 2, 30), datetime.datetime(2015, 11, 1, 0, 30),
+             datetime.datetime(1969, 12, 31, 23, 59, 59, 999999), datetime.datetime(1850, 1, 1),
+             datetime.datetime(2016, 2, 29, 12, 0, 0, 500000)]
+    people = [(u'', u'@handle'), (None, u'@handle'), (u'', u'plain@example.com'),
+              (None, None), (u'N\xe4me', u'x')]
+    rows = []
+    for i, date in enumerate(dates):
+        for j, (name, contact) in enumerate(people):
+            rows.append({'user_id': 1 + (i + j) % 3, 'date': date, 'published': True,
+                         'solution': bool(j % 2), 'vote_count': i * j,
+                         'title': None if j == 3 else u'Caf\xe9 & Co\u2019s &#8217 idea %d' % i,
+                         'short_write_up': u'x', 'name': name, 'contact': contact})
+    idealab.db.engine.execute(Idea.__table__.insert(), rows)
+    idealab.db.engine.execute(Improvement.__table__.insert(), [
+        {'user_id': user_id, 'date': date, 'published': True, 'module': u'm',
+         'link': None, 'type': u't', 'content': u'c', 'contact': u'@c'}
+        for date in dates for user_id in (None, 1, 99999)])
+
+def compare(label, old, new):
+    old, new = json.dumps(old, sort_keys=True), json.dumps(new, sort_keys=True)
+    if old != new:
+        print('MISMATCH %s' % label)
+        for a, b in zip(json.loads(old), json.loads(new)):
+            if a != b:
+                print('  old: %r\n  new: %r' % (a, b))
+                break
+        return 1
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Verify and time the serializers')
+    parser.add_argument('--ideas', type=int, default=2000)
+    parser.add_argument('--improvements', type=int, default=500)
+    parser.add_argument('--tz', default='America/New_York',
+                        help='local timezone to serialize dates in')
+    args = parser.parse_args()
+    os.environ['TZ'] = args.tz
+    time.tzset()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        idealab = synthetic.load(os.path.join(tmp, 'idealab.db'))
+        synthetic.seed(idealab, args.ideas, 50, args.ideas * 5, args.improvements)
+        awkward(idealab)
+        from endpoints import instrument
+        instrument(idealab)
+        app, db, root, failures = idealab.app, idealab.db, idealab.APPLICATION_ROOT, 0
+
+        for user in None, 1, 2:
+            client = app.test_client()
+            if user:
+                client.get(root + '/__bench/login/%d' % user)
+                client.put(root + '/love/idea/3')
+            for Model in idealab.Idea, idealab.Improvement:
+                with app.test_request_context():
+                    if user:
+                        idealab.login_user(idealab.User.query.get(user))
+                    where = idealab.visible(Model)
+                    start = time.time()
+                    objs = Model.query.filter(where).all()
+                    old = [obj.serialized for obj in objs]
+                    old_time = time.time() - start
+                    by_id = {obj.id: serial for obj, serial in zip(objs, old)}
+                    orders = {}
+                    for sort, column in ('-date', Model.date), ('votes', getattr(Model, 'vote_count', None)):
+                        if column is not None:
+                            descending = sort.startswith('-')
+                            orders[sort] = [by_id[id] for id, in db.session.query(Model.id).filter(where)
+                                .order_by(*((column.desc(), Model.id.desc()) if descending else (column, Model.id)))]
+                    db.session.expunge_all()
+                    start = time.time()
+                    new = idealab.serialize(Model, Model.serial_query().filter(where).all())
+                    new_time = time.time() - start
+                label = '%s as %s' % (Model.__tablename__, user or 'anonymous')
+                failures += compare(label, old, new)
+                print('%-28s %6d rows  serialized %7.1f ms  serialize %7.1f ms' % (
+                    label, len(old), old_time * 1000, new_time * 1000))
+
+                # The API, whole and page by page, against the same reference
+                path = '%s/%ss' % (root, Model.__tablename__)
+                failures += compare(label + ' via API', old,
+                                    json.loads(client.get(path).data)['data'])
+                for sort, expected in orders.items():
+                    pages, url = [], '%s?limit=37&sort=%s' % (path, sort)
+                    while url:
+                        page = json.loads(client.get(url).data)
+                        pages += page['data']
+                        url = page['next'] and '%s?limit=37&sort=%s&after=%s' % (path, sort, page['next'])
+                    failures += compare('%s sorted by %s' % (label, sort), expected, pages)
+    finally:
+        shutil.rmtree(tmp)
+    print('%d mismatches' % failures)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
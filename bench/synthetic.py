@@ -0,0 +1,62 @@
+'''
+Throwaway databases full of synthetic users, ideas, improvements and votes
+for the benchmarks. idealab reads its settings when it is imported, so
+load() patches config first and must run before anything else imports it.
+'''
+import datetime
+import os, os.path
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+def load(path, **settings):
+    '''
+    Import idealab against a database at path, overriding any config
+    settings given
+    '''
+    sys.path.insert(0, ROOT)
+    import config
+    config.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+    for name, value in settings.items():
+        setattr(config, name, value)
+    import idealab
+    return idealab
+
+def seed(idealab, ideas=2000, users=200, votes=0, improvements=0):
+    '''
+    Fill the database with the given number of rows. User 1 is an admin,
+    about 80% of everything is published, and votes are spread over
+    random (user, idea) pairs over the last 90 days with vote_count kept
+    consistent.
+    '''
+    engine = idealab.db.engine
+    engine.execute(idealab.User.__table__.insert(), [
+        {'local_id': u'bench%d' % i, 'provider': u'bench', 'provider_id': u'%d' % i,
+         'name': u'Bench %d' % i, 'contact': u'bench%d@example.com' % i, 'admin': i == 0}
+        for i in range(users)])
+    engine.execute(idealab.Idea.__table__.insert(), [
+        {'user_id': random.randint(1, users), 'published': random.random() < 0.8,
+         'solution': False, 'vote_count': 0, 'title': u'Idea %d' % i, 'slug': u'idea-%d' % i,
+         'short_write_up': u'Lorem ipsum ' * 40, 'name': u'Bench', 'contact': u'bench@example.com'}
+        for i in range(ideas)])
+    if improvements:
+        engine.execute(idealab.Improvement.__table__.insert(), [
+            {'user_id': random.randint(1, users), 'published': random.random() < 0.8,
+             'module': u'Module %d' % (i % 50), 'link': u'', 'type': u'typo',
+             'content': u'Lorem ipsum ' * 20, 'contact': u'bench@example.com'}
+            for i in range(improvements)])
+    pairs = set()
+    votes = min(votes, users * ideas)
+    while len(pairs) < votes:
+        pairs.add((random.randint(1, users), random.randint(1, ideas)))
+    if pairs:
+        now = datetime.datetime.utcnow()
+        engine.execute(idealab.IdeaVote.__table__.insert(),
+                       [{'user_id': u, 'idea_id': i,
+                         'date': now - datetime.timedelta(seconds=random.randint(0, 90 * 86400))}
+                        for u, i in pairs])
+        engine.execute('UPDATE idea SET vote_count = '
+                       '(SELECT COUNT(*) FROM idea_vote WHERE idea_id = idea.id)')
+    idealab.db.session.remove()
+    idealab.db.engine.dispose()
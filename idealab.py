@@ -2,28 +2,44 @@
 
 # Quality imports                                                             
 # ////////////////////////////////////////////////////////////////////////////
+import _strptime # Imported lazily by strptime, which races in threads
+import atexit
+import base64
+import bisect
+import calendar
 import csv
 import datetime
+import errno
+import fcntl
 import functools
+import glob
+import gzip
 import hashlib
+import itertools
 import json
+import os
 import re
 import StringIO
 import sys
+import tempfile
+import threading
 import time
+from collections import OrderedDict, deque
 from flask import Flask, Response
-from flask import escape, g, jsonify, redirect, request, session, url_for
+from flask import escape, g, has_request_context, jsonify, redirect, request, session, stream_with_context, url_for
 from flask.ext.admin import Admin, AdminIndexView
 from flask.ext.admin import expose
 from flask.ext.admin.contrib import sqla
 from flask.ext.login import LoginManager, AnonymousUserMixin, UserMixin
 from flask.ext.login import current_user, login_required, login_user, logout_user
-from flask.ext.sqlalchemy import SQLAlchemy
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession
 from flask_oauthlib.client import OAuth, OAuthException
 from jinja2 import Markup
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import column, table
 from wtforms.fields.simple import TextAreaField
 from wtforms.validators import required
-from werkzeug.contrib.cache import SimpleCache
+import config
 from config import (
     APPLICATION_ROOT,
     SECRET_KEY,
@@ -36,6 +52,23 @@ from config import (
     TWITTER_CONSUMER_SECRET,
     OAUTH_REDIRECT,
 )
+# Tuning, with defaults for a config.py from before each setting existed
+# (see config.py.example)
+SQLALCHEMY_POOL_SIZE    = getattr(config, 'SQLALCHEMY_POOL_SIZE', 0)
+SQLITE_PRAGMAS          = getattr(config, 'SQLITE_PRAGMAS', [])
+LOVE_WRITE_BEHIND       = getattr(config, 'LOVE_WRITE_BEHIND', False)
+LOVE_JOURNAL            = getattr(config, 'LOVE_JOURNAL', 'love.journal')
+LOVE_FLUSH_INTERVAL     = getattr(config, 'LOVE_FLUSH_INTERVAL', 1.0)
+LOVE_FLUSH_SIZE         = getattr(config, 'LOVE_FLUSH_SIZE', 500)
+SLOW_REQUEST_SECONDS    = getattr(config, 'SLOW_REQUEST_SECONDS', None)
+STATS_CHECK_INTERVAL    = getattr(config, 'STATS_CHECK_INTERVAL', 300)
+USER_CACHE_SIZE         = getattr(config, 'USER_CACHE_SIZE', 1000)
+USER_CACHE_TTL          = getattr(config, 'USER_CACHE_TTL', 60)
+EVENTS_BUFFER           = getattr(config, 'EVENTS_BUFFER', 1000)
+EVENTS_POLL_INTERVAL    = getattr(config, 'EVENTS_POLL_INTERVAL', 0.5)
+EVENTS_KEEPALIVE        = getattr(config, 'EVENTS_KEEPALIVE', 15)
+SNAPSHOT_DIR            = getattr(config, 'SNAPSHOT_DIR', None)
+SNAPSHOT_DELAY          = getattr(config, 'SNAPSHOT_DELAY', 2.0)
 
 
 # Utilities                                                                   
@@ -50,16 +83,125 @@ def sha1(s):
     return hashlib.sha1(s.encode('utf8')).hexdigest()
 
 def public_name(obj):
-    if not obj.name and obj.contact.startswith('@'):
-        return obj.contact
+    return name_or_handle(obj.name, obj.contact)
+
+def name_or_handle(name, contact):
+    if not name and contact.startswith('@'):
+        return contact
         # Anonymous people here ~~---v
-    return obj.name
+    return name
+
+MONTHS = [datetime.date(2000, month, 1).strftime('%B') for month in range(1, 13)]
+
+def epoch_ms(d):
+    '''
+    int(d.strftime('%s')) * 1000 without going through strftime
+    '''
+    if d.year < 1900:
+        raise ValueError(d) # As strftime does on Python 2
+    return int(time.mktime(d.timetuple())) * 1000
+
+def short_date(d):
+    return '%d.%d.%d' % (d.month, d.day, d.year)
+
+def long_date(d):
+    return '%s %d, %d' % (MONTHS[d.month - 1], d.day, d.year)
+
+def serial_columns(Model, fields=None):
+    '''
+    The columns needed for the given serial_fields of Model (all of them by
+    default), always starting with its id
+    '''
+    columns = OrderedDict([('id', Model.id)])
+    for field in fields or Model.serial_fields:
+        for column in Model.serial_fields[field][0]:
+            columns[column.key] = column
+    return columns.values()
+
+def loved_ideas():
+    '''
+    The set of idea ids current_user has loved, loaded once per request.
+    With write-behind on, their unwritten toggles are applied on top, and
+    g.vote_adjustments records how each one moves the idea's stored count.
+    '''
+    if 'loved_ideas' not in g:
+        g.vote_adjustments = {}
+        if current_user.id == -1:
+            g.loved_ideas = set()
+        else:
+            rows = db.session.query(IdeaVote.idea_id).filter(IdeaVote.user_id==current_user.id)
+            g.loved_ideas = {idea_id for idea_id, in rows}
+        if love_queue and current_user.id != -1:
+            for idea_id in love_queue.pending_for(current_user.id):
+                loved = idea_id not in g.loved_ideas
+                g.vote_adjustments[idea_id] = 1 if loved else -1
+                (g.loved_ideas.add if loved else g.loved_ideas.discard)(idea_id)
+    return g.loved_ideas
+
+def vote_count(idea):
+    '''
+    idea's stored vote count as current_user should see it
+    '''
+    if not love_queue:
+        return idea.vote_count
+    loved_ideas()
+    return idea.vote_count + g.vote_adjustments.get(idea.id, 0)
+
+def slugify(title):
+    #return re.sub(r'\W+', '-', title.lower(), flags=re.U).strip('-')
+    return title.lower().replace(' ', '-').replace('&#8217', '-')
+
+def unique_slug(connection, idea):
+    '''
+    slugify(idea.title), or the first of slug-2, slug-3... that no other
+    idea has, in the database or about to be flushed alongside this one
+    '''
+    slug = slugify(idea.title)
+    pending = {other.slug for other in db.session.new | db.session.dirty
+               if isinstance(other, Idea) and other is not idea}
+    for start in itertools.count(1, 20):
+        candidates = [slug if n == 1 else u'%s-%d' % (slug, n) for n in range(start, start + 20)]
+        taken = pending | {row.slug for row in connection.execute(
+            db.select([Idea.slug]).where(db.and_(Idea.slug.in_(candidates), Idea.id != idea.id)))}
+        for candidate in candidates:
+            if candidate not in taken:
+                return candidate
 
 def n_words(n, string):
     words = string.split()
     return ' '.join(words[:n]) + ('...' if len(words) > n else '')
 
+def remove_if_exists(path):
+    '''
+    os.remove, but a file someone else removed first is fine too
+    '''
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def timed(name):
+    '''
+    Decorator adding the time spent in f, less any SQL it ran, to the
+    current request's metrics under name
+    '''
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*a, **kw):
+            m = g.get('metrics') if has_request_context() else None
+            if m is None:
+                return f(*a, **kw)
+            start, sql = time.time(), m['sql']
+            try:
+                return f(*a, **kw)
+            finally:
+                m[name] += time.time() - start - (m['sql'] - sql)
+        return wrapper
+    return decorator
+
 # JSON responses to accompany HTTP status codes
+@timed('serialize')
 def status(n, **kw):
     kw['message'] = kw.get('message') or {
         200: "Everything is OK",
@@ -77,6 +219,43 @@ def status(n, **kw):
     kw['success'] = str(n)[:1] not in '45'
     return jsonify(**kw), n
 
+def conditional(Model):
+    '''
+    Decorator for GET views of a collection which answers If-None-Match with
+    a 304 before the view runs, and tags every response with an ETag and
+    Last-Modified. Visibility and "loved" differ per viewer, so the ETag
+    covers the current user's id (and any toggles of theirs not yet written)
+    as well as the URL and collection version.
+    Anonymous viewers all see the same thing, so their rendered responses
+    are kept in the response cache under that ETag.
+    '''
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*a, **kw):
+            version, modified = ChangeVersion.get(Model)
+            pending = love_queue.mark(current_user.id) if love_queue else 0
+            etag = sha1(u'{}:{}:{}:{}'.format(request.full_path, version, current_user.id, pending))
+            anonymous = current_user.id == -1
+            body = anonymous and response_cache.get(etag)
+            if etag in request.if_none_match:
+                metrics.cached('not_modified')
+                response, code = Response(status=304), 304
+            elif body:
+                metrics.cached('hit')
+                response, code = Response(body, mimetype='application/json'), 200
+            else:
+                metrics.cached('miss' if anonymous else 'uncached')
+                response, code = f(*a, **kw)
+                if anonymous and code == 200:
+                    response_cache.set(etag, response.get_data())
+            response.set_etag(etag)
+            response.last_modified = modified
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['Vary'] = 'Cookie'
+            return response, code
+        return wrapper
+    return decorator
+
 def post_idea_from_google_forms():
     gas, gasmail = 'Google-Apps-Script', 'fake-email@google.com'
     if gas in request.headers.get('User-Agent'):
@@ -121,6 +300,7 @@ app.config['DEBUG']                     = 'debug' in sys.argv
 app.config['APPLICATION_ROOT']          = APPLICATION_ROOT
 app.config['SECRET_KEY']                = SECRET_KEY
 app.config['SQLALCHEMY_DATABASE_URI']   = SQLALCHEMY_DATABASE_URI
+app.config['SQLALCHEMY_POOL_SIZE']      = SQLALCHEMY_POOL_SIZE
 app.config['SESSION_PROTECTION']        = 'strong'
 
 # Prepend APPLICATION_ROOT to all routes by monkey-patching the route decorator
@@ -141,7 +321,332 @@ def four_oh_three(error):
 
 # Caches
 # ////////////////////////////////////////////////////////////////////////////
-vote_cache = SimpleCache()
+class ResponseCache(object):
+    '''
+    Rendered response bodies kept in least-recently-used order and evicted
+    once their combined size passes max_bytes. Keys are ETags, which change
+    whenever the underlying collection does, so entries never go stale; old
+    ones simply stop being asked for and fall off the end.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            body = self.entries.pop(key, None)
+            if body is not None:
+                self.entries[key] = body
+            return body
+
+    def set(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            self.size -= len(self.entries.pop(key, ''))
+            self.entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self.size -= len(self.entries.popitem(last=False)[1])
+
+response_cache = ResponseCache(16 * 1024 * 1024)
+
+class UserCache(object):
+    '''
+    Detached User rows for the user_loader, so signed-in requests needn't
+    query the user table. Entries expire after ttl seconds, which bounds how
+    long another worker's edit (or one made straight in SQLite) can go
+    unnoticed, and the least recently used are dropped past max_entries.
+    '''
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, id):
+        with self.lock:
+            expires, user = self.entries.pop(id, (0, None))
+            if expires > time.time():
+                self.entries[id] = expires, user
+                return user
+
+    def set(self, id, user):
+        with self.lock:
+            self.entries.pop(id, None)
+            self.entries[id] = time.time() + self.ttl, user
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def discard(self, id):
+        with self.lock:
+            self.entries.pop(id, None)
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+# Write-behind
+# ////////////////////////////////////////////////////////////////////////////
+class LoveQueue(object):
+    '''
+    Buffers love toggles so they reach the database in batches rather than
+    one transaction apiece. Each entry records a toggle, not the state it
+    led to, and is resolved against the database when written: toggles
+    commute, so it doesn't matter which worker's batch lands first.
+
+    Ideas toggled an even number of times are left as they are, but still
+    marked as written (see write), so clients syncing with ?since= fetch
+    them again if they saw them in between.
+
+    Entries are appended (and synced) to a journal segment before the toggle
+    is answered. Every worker holds a lock on its own segments, and whichever
+    worker starts next replays any that were left behind unlocked by a crash.
+    Segments are recorded as written in the same transaction as their
+    toggles (see LoveSegment), so none is ever replayed twice.
+
+    Workers read each other's segments too, skipping those already written,
+    so users see their unwritten toggles whichever worker answers them.
+    '''
+    def __init__(self, journal, interval, size):
+        self.journal = journal
+        self.interval = interval
+        self.size = size
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.pid = None
+        # Toggles read so far from each live segment: {path: [offset, {user_id: {idea_id: n}}]}
+        self.segments = {}
+        self.segments_lock = threading.Lock()
+
+    def segment_path(self, seq):
+        return '%s.%d.%d' % (self.journal, self.pid, seq)
+
+    def open_segment(self):
+        self.seq += 1
+        segment = open(self.segment_path(self.seq), 'a')
+        fcntl.flock(segment, fcntl.LOCK_EX)
+        # Make sure the new file itself survives a crash, not just its lines
+        directory = os.open(os.path.dirname(os.path.abspath(segment.name)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        return segment
+
+    def start(self):
+        '''
+        Set up this worker's queue on its first toggle, after any fork
+        '''
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # (Before taking the pid, so a failure here is retried next time)
+            self.recover()
+            self.pid = os.getpid()
+            # Numbered from the clock so a recycled pid never reuses a name
+            self.seq = int(time.time() * 1000)
+            self.pending, self.count = {}, 0
+            self.retired = []
+            self.segment = self.open_segment()
+        self.closing = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def recover(self):
+        '''
+        Replay the journal segments of workers which died before flushing
+        '''
+        for path in glob.glob(self.journal + '.*.*'):
+            try:
+                segment = open(path)
+            except IOError as e:
+                if e.errno == errno.ENOENT:
+                    continue # Written and removed since the glob
+                raise
+            with segment:
+                try:
+                    fcntl.flock(segment, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    continue # Its worker is still alive
+                if os.fstat(segment.fileno()).st_nlink == 0:
+                    continue # Its worker wrote and removed it while we waited
+                name = unicode(os.path.basename(path))
+                if not LoveSegment.written([name]):
+                    batch = {}
+                    for line in segment:
+                        try:
+                            user_id, idea_id = map(int, line.split())
+                        except ValueError:
+                            continue # Torn final write
+                        ideas = batch.setdefault(user_id, {})
+                        ideas[idea_id] = ideas.get(idea_id, 0) + 1
+                    self.write(batch, [name])
+                remove_if_exists(path)
+                LoveSegment.forget([name])
+
+    def toggle(self, user_id, idea_id):
+        self.start()
+        with self.lock:
+            self.segment.write('%d %d\n' % (user_id, idea_id))
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+            ideas = self.pending.setdefault(user_id, {})
+            ideas[idea_id] = ideas.get(idea_id, 0) + 1
+            self.count += 1
+            if self.count >= self.size:
+                self.wake.set()
+
+    def read_segments(self):
+        '''
+        Catch up with the toggles appended to every worker's live segments,
+        returning the paths of those whose toggles aren't written yet
+        '''
+        paths = set(glob.glob(self.journal + '.*.*'))
+        for path in set(self.segments) - paths:
+            del self.segments[path]
+        for path in paths:
+            seen = self.segments.setdefault(path, [0, {}])
+            try:
+                with open(path) as segment:
+                    segment.seek(seen[0])
+                    data = segment.read()
+            except IOError:
+                continue # Written and removed since the glob
+            end = data.rfind('\n') + 1 # Leave a half-written line for next time
+            seen[0] += end
+            for line in data[:end].splitlines():
+                user_id, idea_id = map(int, line.split())
+                ideas = seen[1].setdefault(user_id, {})
+                ideas[idea_id] = ideas.get(idea_id, 0) + 1
+        # Between a flush's commit and its removing the segment, the database
+        # has these toggles already
+        names = {unicode(os.path.basename(path)): path for path, seen in self.segments.items() if seen[1]}
+        written = {names[name] for name in LoveSegment.written(list(names))} if names else set()
+        return [path for path in self.segments if path not in written]
+
+    def toggles(self, user_id):
+        '''
+        {idea_id: how many times} user_id has toggled each idea since the
+        database last heard from them, in any worker
+        '''
+        toggles = {}
+        with self.segments_lock:
+            for path in self.read_segments():
+                for idea_id, n in self.segments[path][1].get(user_id, {}).items():
+                    toggles[idea_id] = toggles.get(idea_id, 0) + n
+        return toggles
+
+    def pending_for(self, user_id):
+        '''
+        The ids of the ideas whose love user_id has turned around but which
+        aren't written yet
+        '''
+        return {idea_id for idea_id, n in self.toggles(user_id).items() if n % 2}
+
+    def mark(self, user_id):
+        '''
+        Changes whenever user_id toggles something that isn't written yet
+        '''
+        return sum(self.toggles(user_id).values())
+
+    def run(self):
+        while not self.closing:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception('Failed to flush love toggles')
+
+    def flush(self):
+        with self.lock:
+            if not self.pending and not self.retired:
+                return
+            batch, self.pending, self.count = self.pending, {}, 0
+            self.retired.append(self.segment)
+            self.segment = self.open_segment()
+            names = [unicode(os.path.basename(segment.name)) for segment in self.retired]
+        try:
+            self.write(batch, names)
+        except Exception:
+            # Keep the toggles (and their segments) for the next attempt
+            with self.lock:
+                for user_id, ideas in batch.items():
+                    for idea_id, n in self.pending.get(user_id, {}).items():
+                        ideas[idea_id] = ideas.get(idea_id, 0) + n
+                    self.pending[user_id] = ideas
+                self.count = sum(sum(ideas.values()) for ideas in self.pending.values())
+            raise
+        with self.lock:
+            retired, self.retired = self.retired, []
+        # Removed before they're unlocked, so recover() can tell they're done
+        for segment in retired:
+            os.remove(segment.name)
+            segment.close()
+        LoveSegment.forget(names)
+
+    def close(self):
+        # Stop the flusher before the interpreter tears down its globals
+        self.closing = True
+        self.wake.set()
+        self.thread.join()
+        self.flush()
+        os.remove(self.segment.name)
+        self.segment.close()
+
+    @staticmethod
+    def write(batch, segments):
+        '''
+        Apply a batch of {user_id: {idea_id: times toggled}} in one
+        transaction, turning around the love of each idea toggled an odd
+        number of times, and moving its vote_count to match. This bypasses
+        the ORM, so it tells stats, the ranking and /events about them itself.
+        '''
+        votes, deltas, changes, now = IdeaVote.__table__, {}, [], datetime.datetime.utcnow()
+        with db.engine.begin() as connection:
+            connection.execute(LoveSegment.__table__.insert(), [{'name': name} for name in segments])
+            for user_id, ideas in batch.items():
+                for idea_id, n in ideas.items():
+                    deltas.setdefault(idea_id, 0)
+                    if not n % 2:
+                        continue
+                    vote = db.and_(votes.c.user_id==user_id, votes.c.idea_id==idea_id)
+                    row = connection.execute(db.select([votes.c.date]).where(vote)).first()
+                    if row:
+                        date, delta = row.date, -1
+                        connection.execute(votes.delete().where(vote))
+                    else:
+                        date, delta = now, 1
+                        connection.execute(votes.insert(), user_id=user_id, idea_id=idea_id, date=now)
+                    deltas[idea_id] = deltas.get(idea_id, 0) + delta
+                    changes.append((idea_id, delta, date))
+            # Ideas toggled an even number of times keep their count, but are
+            # updated all the same so ChangeVersion.track stamps them
+            for idea_id, delta in deltas.items():
+                connection.execute(Idea.__table__.update().where(Idea.id==idea_id)
+                                   .values(vote_count=Idea.vote_count + delta))
+            deltas = {idea_id: delta for idea_id, delta in deltas.items() if delta}
+            if batch:
+                ChangeVersion.bump(connection, [u'idea'])
+                version = connection.execute(db.select([ChangeVersion.version])
+                                             .where(ChangeVersion.name==u'idea')).scalar()
+                Event.publish(connection, vote_events(connection, list(deltas)))
+        if batch:
+            ranking.update(version, changes)
+            if snapshots and changes:
+                snapshots.changed()
+        counts = {'votes': sum(deltas.values())}
+        for idea_id, n, date in changes:
+            if date:
+                key = 'loves', date.date().isoformat()
+                counts[key] = counts.get(key, 0) + n
+        stats.add(counts)
+
+love_queue = LoveQueue(LOVE_JOURNAL, LOVE_FLUSH_INTERVAL, LOVE_FLUSH_SIZE) if LOVE_WRITE_BEHIND else None
 
 
 # OAuth providers                                                             
@@ -202,7 +707,17 @@ def unauthorized_handler():
 
 @login_manager.user_loader
 def user_loader(id):
-    return User.query.get(id)
+    # The cache holds detached rows; each request merges in its own copy,
+    # which load=False makes without a query
+    id = int(id)
+    user = user_cache.get(id)
+    if user is None:
+        user = User.query.get(id)
+        if user is None:
+            return None
+        db.session.expunge(user)
+        user_cache.set(id, user)
+    return db.session.merge(user, load=False)
 
 # Patch anonymous user object so we can perform basic
 # checks without ensuring a user is logged in
@@ -223,7 +738,29 @@ def admin_required(f):
 
 # Models                                                                      
 # ////////////////////////////////////////////////////////////////////////////
-db = SQLAlchemy(app)
+class SQLiteAlchemy(SQLAlchemy):
+    '''
+    Flask-SQLAlchemy gives file-backed SQLite a NullPool, which reconnects
+    (and so would reapply every pragma) for each checkout. Pool connections
+    instead when SQLALCHEMY_POOL_SIZE asks for it, letting them cross threads.
+    '''
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if info.drivername != 'sqlite':
+            return
+        if options.get('pool_size'):
+            options['poolclass'] = QueuePool
+            options['connect_args'] = {'check_same_thread': False}
+        else:
+            options.pop('pool_size', None)
+
+db = SQLiteAlchemy(app)
+
+@db.event.listens_for(db.engine, 'connect')
+def apply_sqlite_pragmas(connection, record):
+    if db.engine.name == 'sqlite':
+        for pragma, value in SQLITE_PRAGMAS:
+            connection.execute('PRAGMA {} = {}'.format(pragma, value))
 
 
 class ValidMixin(object):
@@ -255,11 +792,11 @@ class ValidMixin(object):
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    local_id = db.Column(db.Unicode(40))
+    local_id = db.Column(db.Unicode(40), index=True)
     provider = db.Column(db.Unicode(50))
     provider_id = db.Column(db.Unicode(50))
     name = db.Column(db.Unicode(500))
-    contact = db.Column(db.Unicode(500))
+    contact = db.Column(db.Unicode(500), index=True)
     admin = db.Column(db.Boolean, default=False)
 
     def __init__(self, local_id, provider, provider_id, name, contact):
@@ -269,6 +806,7 @@ class User(UserMixin, db.Model):
         return u'{} ({})'.format(self.name or self.contact, self.provider)
 
     @property
+    @timed('serialize')
     def serialized(self):
         try:
             return {
@@ -280,25 +818,41 @@ class User(UserMixin, db.Model):
         except: return {}
 
 
+@db.event.listens_for(User, 'after_update')
+@db.event.listens_for(User, 'after_delete')
+def forget_cached_user(mapper, connection, user):
+    # Admin edits, authorize() filling in provider_id, or anything else
+    user_cache.discard(user.id)
+
+
 class Idea(ValidMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user = db.relationship('User', backref=db.backref('ideas', lazy='dynamic'))
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    date = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
     published = db.Column(db.Boolean, default=False)
     solution = db.Column(db.Boolean, default=False)
+    vote_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+
+    version = db.Column(db.Integer, default=0, server_default='0', nullable=False, index=True)
 
     title = db.Column(db.Unicode(500))
+    slug = db.Column(db.Unicode(500), unique=True, index=True)
     short_write_up = db.Column(db.Unicode(5000))
     name = db.Column(db.Unicode(500))
     contact = db.Column(db.Unicode(500))
 
     initialize = 'title', 'short_write_up', 'name', 'contact'
+    __table_args__ = (
+        db.Index('ix_idea_published_date', 'published', 'date'),
+        db.Index('ix_idea_published_vote_count', 'published', 'vote_count'),
+    )
 
     def __repr__(self):
         return self.title
 
     @property
+    @timed('serialize')
     def serialized(self):
         try:
             return {
@@ -309,46 +863,94 @@ class Idea(ValidMixin, db.Model):
                 'short_date': '{d.month}.{d.day}.{d.year}'.format(d=self.date),
                 'long_date': '{} {d.day}, {d.year}'.format(self.date.strftime('%B'), d=self.date),
 
-                #'slug': re.sub(r'\W+', '-', self.title.lower(), flags=re.U).strip('-'),
-                'slug': self.title.lower().replace(' ', '-').replace('&#8217', '-'),
+                'slug': self.slug,
                 'published': self.published,
                 'solution': self.solution,
-                'votes': IdeaVote.cache().get(self.id, 0),
-                'loved': bool(IdeaVote.query.get((current_user.id, self.id))),
+                'votes': vote_count(self),
+                'loved': self.id in loved_ideas(),
 
                 'title': self.title,
                 'short_write_up': self.short_write_up,
             }
         except: return {}
 
+    @staticmethod
+    def serial_query(fields=None):
+        '''
+        Just the columns the given serial_fields need, as tuples rather than
+        objects
+        '''
+        return db.session.query(*serial_columns(Idea, fields))
+
+# Each field of a serialized idea: the columns it needs and how it's made
+Idea.serial_fields = OrderedDict([
+    ('id',              ([Idea.id],                 lambda row: row.id)),
+    ('contributors',    ([Idea.name, Idea.contact], lambda row: [public_name(row)])),
+    ('date',            ([Idea.date],               lambda row: epoch_ms(row.date))),
+    ('short_date',      ([Idea.date],               lambda row: short_date(row.date))),
+    ('long_date',       ([Idea.date],               lambda row: long_date(row.date))),
+    ('slug',            ([Idea.slug],               lambda row: row.slug)),
+    ('published',       ([Idea.published],          lambda row: row.published)),
+    ('solution',        ([Idea.solution],           lambda row: row.solution)),
+    ('votes',           ([Idea.vote_count],         vote_count)),
+    ('loved',           ([],                        lambda row: row.id in loved_ideas())),
+    ('title',           ([Idea.title],              lambda row: row.title)),
+    ('short_write_up',  ([Idea.short_write_up],     lambda row: row.short_write_up)),
+])
+
+@db.event.listens_for(Idea, 'before_insert')
+@db.event.listens_for(Idea, 'before_update')
+def keep_slug(mapper, connection, idea):
+    # Through the API, the admin or anything else that retitles an idea
+    if idea.title is not None and (idea.slug is None or db.inspect(idea).attrs.title.history.has_changes()):
+        idea.slug = unique_slug(connection, idea)
+
 
 class IdeaVote(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
-    idea_id = db.Column(db.Integer, db.ForeignKey('idea.id'), primary_key=True)
+    idea_id = db.Column(db.Integer, db.ForeignKey('idea.id'), primary_key=True, index=True)
+    date = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
 
     def __init__(self, user_id, idea_id):
         self.user_id = user_id
         self.idea_id = idea_id
+        self.date = datetime.datetime.utcnow()
 
     @staticmethod
-    def cache(update_id=None):
-        counts = vote_cache.get('ideas')
-        if counts is None:
-            counts = {obj.id: IdeaVote.query.filter(IdeaVote.idea_id==obj.id).count()
-                     for obj in Idea.query.all()}
-            vote_cache.set('ideas', counts, timeout=60 * 5)
-        elif update_id is not None:
-            counts[update_id] = IdeaVote.query.filter(IdeaVote.idea_id==update_id).count()
-            vote_cache.set('ideas', counts, timeout=60 * 5)
-        return counts
+    def count():
+        '''
+        Votes per idea counted from this table, for checking Idea.vote_count
+        '''
+        rows = db.session.query(IdeaVote.idea_id, db.func.count(IdeaVote.user_id))\
+                         .group_by(IdeaVote.idea_id)
+        return dict(rows.all())
+
+    @staticmethod
+    def reconcile(repair=False):
+        '''
+        Compare Idea.vote_count against this table and return a list of
+        (idea_id, stored, actual) for every idea that has drifted
+        '''
+        stored = dict(db.session.query(Idea.id, Idea.vote_count).filter(Idea.vote_count != 0))
+        actual = IdeaVote.count()
+        drift = [(id, stored.get(id, 0), actual.get(id, 0))
+                 for id in sorted(set(stored) | set(actual))
+                 if stored.get(id, 0) != actual.get(id, 0)]
+        if repair and drift:
+            for id, _, n in drift:
+                Idea.query.filter(Idea.id==id).update({Idea.vote_count: n}, synchronize_session=False)
+            ChangeVersion.bump(db.session, [u'idea'])
+            db.session.commit()
+        return drift
 
 
 class Improvement(ValidMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user = db.relationship('User', backref=db.backref('improvements', lazy='dynamic'))
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    date = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
     published = db.Column(db.Boolean, default=False)
+    version = db.Column(db.Integer, default=0, server_default='0', nullable=False, index=True)
 
     module = db.Column(db.Unicode(500))
     link = db.Column(db.Unicode(5000))
@@ -357,11 +959,15 @@ class Improvement(ValidMixin, db.Model):
     contact = db.Column(db.Unicode(500))
 
     initialize = 'module', 'link', 'type', 'content', 'contact'
+    __table_args__ = (
+        db.Index('ix_improvement_published_date', 'published', 'date'),
+    )
 
     def __repr__(self):
         return u'{} ({})'.format(self.type, self.module)
 
     @property
+    @timed('serialize')
     def serialized(self):
         try: 
             return {
@@ -381,8 +987,864 @@ class Improvement(ValidMixin, db.Model):
             }
         except: return {}
 
+    @staticmethod
+    def serial_query(fields=None):
+        '''
+        Just the columns the given serial_fields need, joining in the user
+        only when their name is one of them
+        '''
+        query = db.session.query(*serial_columns(Improvement, fields)).select_from(Improvement)
+        if fields is None or 'username' in fields:
+            query = query.outerjoin(User, User.id==Improvement.user_id)
+        return query
+
+# Each field of a serialized improvement: the columns it needs and how it's made
+Improvement.serial_fields = OrderedDict([
+    ('id',              ([Improvement.id],          lambda row: row.id)),
+    ('username',        ([User.name.label('user_name'), User.contact.label('user_contact')],
+                         lambda row: name_or_handle(row.user_name, row.user_contact))),
+    ('published',       ([Improvement.published],   lambda row: row.published)),
+    ('date',            ([Improvement.date],        lambda row: epoch_ms(row.date))),
+    ('short_date',      ([Improvement.date],        lambda row: short_date(row.date))),
+    ('long_date',       ([Improvement.date],        lambda row: long_date(row.date))),
+    ('module',          ([Improvement.module],      lambda row: row.module)),
+    ('link',            ([Improvement.link],        lambda row: row.link)),
+    ('type',            ([Improvement.type],        lambda row: row.type)),
+    ('content',         ([Improvement.content],     lambda row: row.content)),
+    ('contact',         ([Improvement.contact],     lambda row: row.contact)),
+])
+
+
+class ChangeVersion(db.Model):
+    '''
+    A counter per collection which is bumped in the same transaction as any
+    write touching it (API, admin or otherwise), so readers can tell cheaply
+    whether anything has changed since they last looked.
+    '''
+    name = db.Column(db.Unicode(50), primary_key=True)
+    version = db.Column(db.Integer, default=0, nullable=False)
+    modified = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    # Which collection a write to each table shows up in
+    tracked = {
+        'idea': u'idea',
+        'idea_vote': u'idea',
+        'improvement': u'improvement',
+    }
+
+    @staticmethod
+    def bump(session, names):
+        session.execute(ChangeVersion.__table__.update()
+            .where(ChangeVersion.name.in_(names))
+            .values(version=ChangeVersion.version + 1, modified=datetime.datetime.utcnow()))
+        if isinstance(session, SignallingSession):
+            # For snapshot_changes
+            session.info['changed'] = True
+
+    @staticmethod
+    def get(Model):
+        row = db.session.query(ChangeVersion.version, ChangeVersion.modified)\
+                        .filter(ChangeVersion.name==ChangeVersion.tracked[Model.__tablename__]).first()
+        return row or (0, None)
+
+    @staticmethod
+    def track(Model):
+        '''
+        Stamp each row of Model with the collection version of the last write
+        to it, and leave a Tombstone for each row deleted. It's done by
+        triggers, so every writer (the API, the admin and import.py alike)
+        is tracked. Writers bump the version after writing their rows in the
+        same transaction, so the version those rows get is the current one
+        plus one.
+        '''
+        version = "(SELECT version + 1 FROM change_version WHERE name = '{}')".format(
+            ChangeVersion.tracked[Model.__tablename__])
+        for statement in (
+            "CREATE TRIGGER IF NOT EXISTS {t}_version_insert AFTER INSERT ON {t} BEGIN "
+                "UPDATE {t} SET version = {v} WHERE id = new.id; END",
+            # (Its own update of version doesn't count)
+            "CREATE TRIGGER IF NOT EXISTS {t}_version_update AFTER UPDATE ON {t} "
+                "WHEN new.version IS old.version BEGIN "
+                "UPDATE {t} SET version = {v} WHERE id = new.id; END",
+            "CREATE TRIGGER IF NOT EXISTS {t}_version_delete AFTER DELETE ON {t} BEGIN "
+                "INSERT OR REPLACE INTO tombstone (name, id, version) VALUES ('{t}', old.id, {v}); END",
+        ):
+            db.session.execute(statement.format(t=Model.__tablename__, v=version))
+        db.session.commit()
+
+@db.event.listens_for(SignallingSession, 'after_flush')
+def bump_change_versions(session, flush_context):
+    changed = {ChangeVersion.tracked.get(obj.__tablename__)
+               for obj in session.new | session.dirty | session.deleted}
+    changed.discard(None)
+    if changed:
+        ChangeVersion.bump(session, changed)
+
+
+class Event(db.Model):
+    '''
+    The last EVENTS_BUFFER public changes, as JSON, for /events. Writers add
+    them in the same transaction as the change, so every worker's event hub
+    sees the same events in the same order, under the same ids.
+    '''
+    __table_args__ = {'sqlite_autoincrement': True}
+    id = db.Column(db.Integer, primary_key=True)
+    data = db.Column(db.UnicodeText, nullable=False)
+
+    @staticmethod
+    def publish(connection, events):
+        for event in events:
+            last = connection.execute(Event.__table__.insert(), {'data': unicode(json.dumps(event))}).lastrowid
+        if events:
+            connection.execute(Event.__table__.delete().where(Event.id <= last - EVENTS_BUFFER))
+
+class Tombstone(db.Model):
+    '''
+    The ids of deleted rows and the collection version that deleted them,
+    for clients syncing with ?since=
+    '''
+    name = db.Column(db.Unicode(50), primary_key=True)
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_tombstone_name_version', 'name', 'version'),
+    )
+
+def idea_event(idea):
+    '''
+    What the public gets told about idea: everything anyone may see of it
+    while published, or just that it's gone. Like serialize, an idea
+    which can't be serialized (say, one without a date) gives {}.
+    '''
+    if not idea.published:
+        return {'type': 'removed', 'id': idea.id}
+    try:
+        data = {name: make(idea) for name, (columns, make) in Idea.serial_fields.items()
+                if name not in ('votes', 'loved')}
+        data['votes'] = idea.vote_count
+    except (AttributeError, TypeError, ValueError):
+        data = {}
+    return {'type': 'idea', 'id': idea.id, 'idea': data}
+
+@db.event.listens_for(SignallingSession, 'after_flush')
+def publish_idea_events(session, flush_context):
+    # Newly published ideas, edits and deletions (API, admin or otherwise)
+    events = []
+    for idea in session.new | session.dirty | session.deleted:
+        if not isinstance(idea, Idea) or idea in session.dirty and not session.is_modified(idea):
+            continue
+        history = db.inspect(idea).attrs.published.history
+        was_published = history.deleted[0] if history.deleted else idea.published
+        if idea in session.deleted:
+            if was_published:
+                events.append({'type': 'removed', 'id': idea.id})
+        elif idea.published or idea in session.dirty and was_published:
+            events.append(idea_event(idea))
+    Event.publish(session, events)
+
+def vote_events(connection, idea_ids):
+    '''
+    The new vote counts of whichever of idea_ids are published
+    '''
+    if not idea_ids:
+        return []
+    rows = connection.execute(db.select([Idea.id, Idea.vote_count])
+                              .where(db.and_(Idea.id.in_(idea_ids), Idea.published==True)))
+    return [{'type': 'votes', 'id': id, 'votes': votes} for id, votes in rows]
+
+
+class LoveSegment(db.Model):
+    '''
+    The names of love journal segments whose toggles are in the database
+    (see LoveQueue), kept until the segment files themselves are removed
+    '''
+    name = db.Column(db.Unicode(200), primary_key=True)
+
+    @staticmethod
+    def written(names):
+        return {name for name, in db.engine.execute(
+            db.select([LoveSegment.name]).where(LoveSegment.name.in_(names)))}
+
+    @staticmethod
+    def forget(names):
+        db.engine.execute(LoveSegment.__table__.delete().where(LoveSegment.name.in_(names)))
+
+class SearchIndex(object):
+    '''
+    An SQLite FTS5 index over some text columns of a model. The index is an
+    external content table kept in step with the model's table by triggers,
+    so every writer (the API, the admin and import.py alike) keeps it current.
+    The admin searches all of columns; the public search only matches, and
+    takes snippets from, those of them which are public.
+    '''
+    def __init__(self, Model, columns, public=None):
+        self.Model = Model
+        self.columns = columns
+        self.public = public or columns
+        self.table = Model.__tablename__
+        self.name = self.table + '_search'
+
+    def create(self):
+        if db.session.execute("SELECT 1 FROM sqlite_master WHERE name=:name", {'name': self.name}).first():
+            return
+        names = ', '.join(self.columns)
+        new = ', '.join('new.' + c for c in self.columns)
+        old = ', '.join('old.' + c for c in self.columns)
+        for statement in (
+            "CREATE VIRTUAL TABLE {n} USING fts5({cols}, content='{t}', content_rowid='id')",
+            "CREATE TRIGGER {n}_insert AFTER INSERT ON {t} BEGIN "
+                "INSERT INTO {n}(rowid, {cols}) VALUES (new.id, {new}); END",
+            "CREATE TRIGGER {n}_delete AFTER DELETE ON {t} BEGIN "
+                "INSERT INTO {n}({n}, rowid, {cols}) VALUES ('delete', old.id, {old}); END",
+            "CREATE TRIGGER {n}_update AFTER UPDATE OF {cols} ON {t} BEGIN "
+                "INSERT INTO {n}({n}, rowid, {cols}) VALUES ('delete', old.id, {old}); "
+                "INSERT INTO {n}(rowid, {cols}) VALUES (new.id, {new}); END",
+        ):
+            db.session.execute(statement.format(n=self.name, t=self.table, cols=names, new=new, old=old))
+        self.rebuild()
+
+    def rebuild(self):
+        db.session.execute("INSERT INTO {0}({0}) VALUES ('rebuild')".format(self.name))
+        db.session.commit()
+
+    def match(self, q, columns=None):
+        '''
+        A MATCH clause for q, in any of columns if given. Each word is quoted
+        so user input can never be a syntax error, and all of them must appear.
+        '''
+        terms = ' '.join(u'"{}"'.format(term.replace('"', '""')) for term in q.split())
+        if columns:
+            terms = u'{{{}}} : ({})'.format(' '.join(columns), terms)
+        return db.text('{} MATCH :terms'.format(self.name)).bindparams(terms=terms)
+
+    def ids(self, q):
+        return db.select([column('rowid')]).select_from(table(self.name)).where(self.match(q))
+
+    def search(self, q, where, limit):
+        '''
+        Objects matching q, best first, each with a snippet of the matching
+        text in which matched terms are delimited by the STX and ETX characters
+        '''
+        fts = table(self.name, column('rowid'))
+        # The first public column with a match in it, since snippet() with
+        # -1 would pick among all of them
+        snippets = ["snippet({}, {}, char(2), char(3), '...', 16)".format(self.name, self.columns.index(c))
+                    for c in self.public]
+        snippet = snippets[-1]
+        for first in reversed(snippets[:-1]):
+            snippet = "CASE WHEN instr({0}, char(2)) THEN {0} ELSE {1} END".format(first, snippet)
+        snippet = db.literal_column(snippet)
+        rank = db.literal_column('bm25({})'.format(self.name))
+        return db.session.query(self.Model, snippet).join(fts, fts.c.rowid==self.Model.id)\
+                 .filter(self.match(q, self.public), where).order_by(rank).limit(limit).all()
+
+# Ideas never show their author's contact, and only sometimes their name
+Idea.search_index = SearchIndex(Idea, ('title', 'short_write_up', 'name', 'contact'),
+                                public=('title', 'short_write_up'))
+Improvement.search_index = SearchIndex(Improvement, ('module', 'type', 'content', 'contact'))
+
 
 db.create_all()
+for name in set(ChangeVersion.tracked.values()):
+    db.session.execute(ChangeVersion.__table__.insert().prefix_with('OR IGNORE')
+        .values(name=name, version=0, modified=datetime.datetime.utcnow()))
+# Slug ideas from before there was a slug column (migrations/0005_slug.sql)
+for idea in Idea.query.filter(Idea.slug==None, Idea.title!=None).order_by(Idea.id).all():
+    idea.slug = unique_slug(db.session.connection(), idea)
+    db.session.flush()
+db.session.commit()
+Idea.search_index.create()
+Improvement.search_index.create()
+ChangeVersion.track(Idea)
+ChangeVersion.track(Improvement)
+# Don't let pooled connections opened during setup leak into forked workers
+db.session.remove()
+db.engine.dispose()
+
+
+# Metrics
+# ////////////////////////////////////////////////////////////////////////////
+class Metrics(object):
+    '''
+    Request latency histograms and query, SQL time and serialization time
+    totals per endpoint, plus response cache outcomes, for Prometheus to
+    scrape from /metrics. They're kept in memory, so each worker process
+    reports its own. Requests collect their figures on g.metrics and fold
+    them in here once, when they're torn down.
+    '''
+    buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.responses = {}
+        self.cache = {}
+
+    def observe(self, endpoint, code, seconds, m):
+        with self.lock:
+            e = self.endpoints.get(endpoint)
+            if e is None:
+                e = self.endpoints[endpoint] = {'buckets': [0] * len(self.buckets),
+                    'count': 0, 'sum': 0.0, 'queries': 0, 'sql': 0.0, 'serialize': 0.0}
+            for i, le in enumerate(self.buckets):
+                if seconds <= le:
+                    e['buckets'][i] += 1
+            e['count'] += 1
+            e['sum'] += seconds
+            e['queries'] += m['queries']
+            e['sql'] += m['sql']
+            e['serialize'] += m['serialize']
+            self.responses[endpoint, code] = self.responses.get((endpoint, code), 0) + 1
+
+    def cached(self, result):
+        with self.lock:
+            self.cache[result] = self.cache.get(result, 0) + 1
+
+    def render(self):
+        lines = []
+        def metric(name, kind, help, samples):
+            lines.append('# HELP idealab_{} {}'.format(name, help))
+            lines.append('# TYPE idealab_{} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                labels = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+                lines.append('idealab_{}{}{{{}}} {}'.format(name, suffix, labels, value))
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            metric('request_seconds', 'histogram', 'Time to answer a request, streaming included',
+                [('_bucket', [('endpoint', name), ('le', le)], n)
+                 for name, e in endpoints
+                 for le, n in zip(self.buckets + ('+Inf',), e['buckets'] + [e['count']])] +
+                [(suffix, [('endpoint', name)], e[key])
+                 for name, e in endpoints for suffix, key in (('_sum', 'sum'), ('_count', 'count'))])
+            metric('requests_total', 'counter', 'Requests answered, by status code',
+                [('', [('endpoint', name), ('status', code)], n)
+                 for (name, code), n in sorted(self.responses.items())])
+            for key, name, help in (
+                    ('queries', 'request_queries_total', 'SQL statements executed'),
+                    ('sql', 'request_sql_seconds_total', 'Time spent executing SQL'),
+                    ('serialize', 'request_serialize_seconds_total', 'Time spent serializing, less SQL')):
+                metric(name, 'counter', help, [('', [('endpoint', n)], e[key]) for n, e in endpoints])
+            metric('response_cache_total', 'counter', 'Conditional GETs by how they were answered',
+                [('', [('result', result)], n) for result, n in sorted(self.cache.items())])
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+@app.before_request
+def start_request_metrics():
+    g.metrics = {'start': time.time(), 'queries': 0, 'sql': 0.0, 'serialize': 0.0,
+                 'status': 500, 'statements': [] if SLOW_REQUEST_SECONDS else None}
+
+@app.after_request
+def record_status(response):
+    if 'metrics' in g:
+        g.metrics['status'] = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    m = g.pop('metrics', None)
+    if m is None:
+        return
+    seconds = time.time() - m['start']
+    metrics.observe(request.endpoint or 'unknown', m['status'], seconds, m)
+    if SLOW_REQUEST_SECONDS and seconds >= SLOW_REQUEST_SECONDS:
+        # Flask's production handler drops anything below ERROR
+        app.logger.error('Slow request: %s %s took %.3fs with %d queries in %.3fs\n%s',
+            request.method, request.full_path, seconds, m['queries'], m['sql'],
+            '\n'.join('  %.4fs %s %r' % s for s in m['statements']))
+
+@db.event.listens_for(db.engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.time())
+
+@db.event.listens_for(db.engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.time() - conn.info['query_start'].pop()
+    m = g.get('metrics') if has_request_context() else None
+    if m is not None:
+        m['queries'] += 1
+        m['sql'] += seconds
+        if m['statements'] is not None:
+            m['statements'].append((seconds, ' '.join(statement.split()), parameters))
+
+
+# Statistics
+# ////////////////////////////////////////////////////////////////////////////
+class Stats(object):
+    '''
+    Totals and per-day rates for the admin dashboard and /stats, kept in
+    memory. Every committed session adds what it inserted, updated or
+    deleted, as gathered by the mapper events below. Writes this process
+    never sees (other workers, import.py) are caught by a recount against
+    the database every `interval` seconds, which also notes any drift.
+    Loves per day count the votes still standing by the day they were
+    given; those from before votes were dated aren't counted.
+    '''
+    days = 30
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.checked = None
+        self.drift = {}
+
+    def add(self, deltas):
+        with self.lock:
+            for key, n in deltas.items():
+                self.counts[key] = self.counts.get(key, 0) + n
+
+    def recount(self):
+        since = datetime.datetime.utcnow().date() - datetime.timedelta(days=self.days - 1)
+        published = lambda Model: db.func.sum(db.case([(Model.published == True, 1)], else_=0))
+        counts = {'users': User.query.count(), 'votes': IdeaVote.query.count()}
+        counts['ideas'], counts['ideas_published'], counts['ideas_solutions'] = \
+            db.session.query(db.func.count(Idea.id), published(Idea),
+                             db.func.sum(db.case([(Idea.solution == True, 1)], else_=0))).one()
+        counts['improvements'], counts['improvements_published'] = \
+            db.session.query(db.func.count(Improvement.id), published(Improvement)).one()
+        for name, Model in ('ideas', Idea), ('improvements', Improvement), ('loves', IdeaVote):
+            day = db.func.date(Model.date)
+            for date, n in db.session.query(day, db.func.count()).filter(Model.date >= since).group_by(day):
+                counts[name, date] = n
+        counts = {key: n or 0 for key, n in counts.items()}
+        with self.lock:
+            # Before the first count there's nothing to have drifted from:
+            # self.counts only holds what the hooks added since startup
+            if self.checked is not None:
+                mine = {key: n for key, n in self.counts.items()
+                        if not isinstance(key, tuple) or key[1] >= since.isoformat()}
+                self.drift = {'_'.join(key) if isinstance(key, tuple) else key: counts.get(key, 0) - n
+                              for key, n in mine.items() if counts.get(key, 0) != n}
+            self.counts = counts
+            self.checked = datetime.datetime.utcnow()
+
+    def snapshot(self):
+        if not self.checked or (datetime.datetime.utcnow() - self.checked).total_seconds() > self.interval:
+            self.recount()
+        with self.lock:
+            c = dict(self.counts)
+        days = [(datetime.datetime.utcnow().date() - datetime.timedelta(days=n)).isoformat()
+                for n in range(self.days)]
+        per_day = lambda name: OrderedDict((day, c.get((name, day), 0)) for day in days)
+        return {
+            'users': c.get('users', 0),
+            'ideas': {
+                'total': c.get('ideas', 0),
+                'published': c.get('ideas_published', 0),
+                'unpublished': c.get('ideas', 0) - c.get('ideas_published', 0),
+                'solutions': c.get('ideas_solutions', 0),
+            },
+            'improvements': {
+                'total': c.get('improvements', 0),
+                'published': c.get('improvements_published', 0),
+                'unpublished': c.get('improvements', 0) - c.get('improvements_published', 0),
+            },
+            'votes': c.get('votes', 0),
+            'per_day': {name: per_day(name) for name in ('ideas', 'improvements', 'loves')},
+            'checked': self.checked.isoformat() + 'Z',
+            'drift': self.drift,
+        }
+
+stats = Stats(STATS_CHECK_INTERVAL)
+
+def stat_keys(obj, value):
+    '''
+    The counters obj adds to, given value(attribute) for its state. Rows
+    without a date (such as votes from before votes were dated) count
+    only towards the totals.
+    '''
+    name = {Idea: 'ideas', Improvement: 'improvements', IdeaVote: 'votes'}.get(type(obj), 'users')
+    keys = [name]
+    if name != 'users' and value('date'):
+        keys.append(('loves' if name == 'votes' else name, value('date').date().isoformat()))
+    if name in ('ideas', 'improvements'):
+        keys += [name + '_published'] * bool(value('published'))
+    if name == 'ideas':
+        keys += ['ideas_solutions'] * bool(value('solution'))
+    return keys
+
+def stat_deltas(obj, n):
+    deltas = db.object_session(obj).info.setdefault('stats', {})
+    for key in stat_keys(obj, lambda attr: getattr(obj, attr)):
+        deltas[key] = deltas.get(key, 0) + n
+    return deltas
+
+def stats_inserted(mapper, connection, obj):
+    stat_deltas(obj, +1)
+
+def stats_deleted(mapper, connection, obj):
+    stat_deltas(obj, -1)
+
+def stats_updated(mapper, connection, obj):
+    def old(attr):
+        history = db.inspect(obj).attrs[attr].history
+        return history.deleted[0] if history.deleted else getattr(obj, attr)
+    deltas = stat_deltas(obj, +1)
+    for key in stat_keys(obj, old):
+        deltas[key] = deltas.get(key, 0) - 1
+
+for Model in User, Idea, Improvement, IdeaVote:
+    db.event.listen(Model, 'after_insert', stats_inserted)
+    db.event.listen(Model, 'after_delete', stats_deleted)
+    db.event.listen(Model, 'after_update', stats_updated)
+
+@db.event.listens_for(SignallingSession, 'after_commit')
+def commit_stats(session):
+    stats.add(session.info.pop('stats', {}))
+
+@db.event.listens_for(SignallingSession, 'after_rollback')
+def discard_stats(session):
+    session.info.pop('stats', None)
+
+
+# Rankings
+# ////////////////////////////////////////////////////////////////////////////
+class Ranked(object):
+    '''
+    Ids kept sorted by score, highest first (newest first among equals), so
+    the top n are a slice and a change of score is two binary searches
+    '''
+    def __init__(self, scores):
+        self.scores = scores
+        self.keys = sorted((-score, -id) for id, score in scores.items())
+
+    def add(self, id, n):
+        if id not in self.scores:
+            return
+        del self.keys[bisect.bisect_left(self.keys, (-self.scores[id], -id))]
+        self.scores[id] += n
+        bisect.insort(self.keys, (-self.scores[id], -id))
+
+    def top(self, n):
+        return [-id for score, id in self.keys[:n]]
+
+class Ranking(object):
+    '''
+    Published ideas ranked by loves for /ideas/top: all time by vote count,
+    and trending by loves that decay with a half-life of a day, week or
+    month. A love from t seconds after the ranking was built scores 2**(t/h)
+    for half-life h, which keeps the order right as time passes without
+    rescoring anything.
+    The ranking is as of one idea collection version. Loves this process
+    writes move it on incrementally (see update); any other change to the
+    collection, or this process falling behind, has the next read start a
+    rebuild from the database in the background and answer from the
+    ranking it has until that's done. Only the first read waits for one.
+    '''
+    windows = OrderedDict([('all', None), ('day', 86400), ('week', 7 * 86400), ('month', 30 * 86400)])
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.built = 0
+        self.ranked = {}
+        self.rebuilding = None
+
+    def score(self, date, half_life):
+        if not date:
+            return 0.0
+        return 2 ** ((calendar.timegm(date.timetuple()) - self.built) / float(half_life))
+
+    def rebuild(self):
+        # Straight through the engine: this runs outside any request
+        version = db.select([ChangeVersion.version]).where(ChangeVersion.name==u'idea')
+        with db.engine.connect() as connection:
+            before = connection.execute(version).scalar()
+            built = time.time()
+            counts = dict(connection.execute(db.select([Idea.id, Idea.vote_count])
+                                             .where(Idea.published==True)).fetchall())
+            votes = connection.execute(db.select([IdeaVote.idea_id, IdeaVote.date])
+                                       .select_from(IdeaVote.__table__.join(Idea.__table__))
+                                       .where(db.and_(Idea.published==True, IdeaVote.date!=None))).fetchall()
+            after = connection.execute(version).scalar()
+        with self.lock:
+            self.built = built
+            ranked = {'all': Ranked(counts)}
+            for window, half_life in self.windows.items():
+                if half_life:
+                    scores = dict.fromkeys(counts, 0.0)
+                    for idea_id, date in votes:
+                        scores[idea_id] += self.score(date, half_life)
+                    ranked[window] = Ranked(scores)
+            # A write during the scan may or may not be in it, so leave the
+            # version unknown and have the next read rebuild again
+            self.ranked, self.version = ranked, before if before == after else None
+
+    def refresh(self):
+        '''
+        Start a rebuild in the background unless one is already running
+        '''
+        with self.lock:
+            if self.rebuilding and self.rebuilding.is_alive():
+                return
+            self.rebuilding = threading.Thread(target=self.run)
+            self.rebuilding.daemon = True
+            self.rebuilding.start()
+
+    def run(self):
+        try:
+            self.rebuild()
+        except Exception:
+            app.logger.exception('Failed to rebuild the ranking')
+
+    def update(self, version, changes):
+        '''
+        Apply the (idea_id, +1 or -1, vote date) changes of a write which
+        took the idea collection to version, if nothing else came between
+        '''
+        with self.lock:
+            if self.version != version - 1:
+                self.version = None
+                return
+            for idea_id, n, date in changes:
+                for window, half_life in self.windows.items():
+                    self.ranked[window].add(idea_id, n * self.score(date, half_life) if half_life else n)
+            self.version = version
+
+    def top(self, n, window):
+        '''
+        The ids of the n highest ranked ideas in window
+        '''
+        version, _ = ChangeVersion.get(Idea)
+        # Rebuilt well before new loves' 2**(t/h) can overflow a float
+        stale = time.time() - self.built > 512 * min(filter(None, self.windows.values()))
+        if not self.ranked:
+            self.rebuild()
+        elif version != self.version or stale:
+            self.refresh()
+        with self.lock:
+            return self.ranked[window].top(n)
+
+ranking = Ranking()
+
+
+# Events
+# ////////////////////////////////////////////////////////////////////////////
+class EventHub(object):
+    '''
+    Fans the event table out to every /events connection in this process.
+    One thread per process polls the table every `interval` seconds and
+    keeps the last `size` events in memory for clients resuming from a
+    Last-Event-ID. Connections block on a condition, with no timeout, which
+    that thread notifies on new events and every `keepalive` seconds, so
+    idle ones cost a thread each (or a greenlet under gevent workers) and
+    neither queries nor wakeups in between.
+    '''
+    def __init__(self, size, interval, keepalive):
+        self.size = size
+        self.interval = interval
+        self.keepalive = keepalive
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.events = deque(maxlen=size)
+        self.last = 0
+        self.pid = None
+        self.closing = threading.Event()
+
+    def start(self):
+        # Lazily, and again in each forked worker
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.events.clear()
+            self.last = db.engine.execute(db.select([db.func.max(Event.id)])).scalar() or 0
+            self.poll(self.last - self.size)
+        self.closing.clear()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def poll(self, after):
+        rows = db.engine.execute(db.select([Event.id, Event.data])
+                                 .where(Event.id > after).order_by(Event.id)).fetchall()
+        self.events.extend(rows)
+        if rows:
+            self.last = rows[-1].id
+        return rows
+
+    def run(self):
+        # Sleep rather than wait on closing: timed waits poll on Python 2
+        notified = time.time()
+        while not self.closing.is_set():
+            time.sleep(self.interval)
+            try:
+                with self.lock:
+                    if self.poll(self.last) or time.time() - notified >= self.keepalive:
+                        notified = time.time()
+                        self.changed.notify_all()
+            except Exception:
+                app.logger.exception('Polling for events failed')
+
+    def close(self):
+        # Stop polling before the interpreter tears down its globals
+        self.closing.set()
+        self.thread.join()
+
+    def since(self, last):
+        '''
+        The events after id last, waiting for some, or [] if none came
+        before the next keepalive. None if some have already left the buffer.
+        '''
+        with self.lock:
+            if last < self.last:
+                first = self.events[0].id if self.events else self.last + 1
+                if last < first - 1:
+                    return None
+            else:
+                self.changed.wait()
+            events = []
+            for event in reversed(self.events):
+                if event.id <= last:
+                    break
+                events.append(event)
+            return events[::-1]
+
+event_hub = EventHub(EVENTS_BUFFER, EVENTS_POLL_INTERVAL, EVENTS_KEEPALIVE)
+
+def event_stream(last):
+    yield 'retry: 2000\n\n'
+    while True:
+        events = event_hub.since(last)
+        if events is None:
+            # Missed too much to catch up: the client should refetch instead
+            last = event_hub.last
+            yield 'id: %d\ndata: {"type": "reset"}\n\n' % last
+        elif not events:
+            yield ': keepalive\n\n'
+        else:
+            last = events[-1].id
+            yield ''.join('id: %d\ndata: %s\n\n' % (event.id, event.data.encode('utf8'))
+                          for event in events)
+
+
+# Snapshots
+# ////////////////////////////////////////////////////////////////////////////
+class Snapshots(object):
+    '''
+    The published collections exactly as anonymous viewers GET them, written
+    to directory as <collection>.json and .json.gz for nginx to serve
+    without asking the API (see the README). After a change the snapshots
+    wait for `delay` quiet seconds (but no more than ten times that), so a
+    burst of writes costs one rewrite. Files are replaced atomically, and
+    a collection is only rewritten when its version differs from the one
+    recorded in directory/versions.json, so several workers share the work.
+    '''
+    collections = OrderedDict([('ideas', Idea), ('improvements', Improvement)])
+
+    def __init__(self, directory, delay):
+        self.directory = directory
+        self.delay = delay
+        self.wake = threading.Event()
+        self.pid = None
+
+    def start(self):
+        # Lazily, and again in each forked worker
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.closing = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def changed(self):
+        self.start()
+        self.wake.set()
+
+    def run(self):
+        while not self.closing:
+            self.wake.wait()
+            deadline = time.time() + 10 * self.delay
+            while not self.closing and time.time() < deadline:
+                self.wake.clear()
+                if not self.wake.wait(min(self.delay, deadline - time.time())):
+                    break
+            try:
+                self.write()
+            except Exception:
+                app.logger.exception('Failed to write snapshots')
+
+    def write(self, force=False):
+        '''
+        Rewrite the snapshots of whichever collections have changed (or all
+        of them if force)
+        '''
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            path = os.path.join(self.directory, 'versions.json')
+            try:
+                with open(path) as file:
+                    versions = json.load(file)
+            except (IOError, ValueError):
+                versions = {}
+            try:
+                for name, Model in self.collections.items():
+                    # (Read first: a write while rendering only makes the next rewrite come sooner)
+                    version, _ = ChangeVersion.get(Model)
+                    if force or versions.get(name) != version:
+                        body = self.render(name, Model)
+                        self.replace(name + '.json', body)
+                        self.replace(name + '.json.gz', self.compress(body))
+                        versions[name] = version
+            finally:
+                db.session.remove()
+            self.replace('versions.json', json.dumps(versions))
+
+    @staticmethod
+    def render(name, Model):
+        '''
+        The body of an anonymous GET /<name>
+        '''
+        with app.test_request_context(APPLICATION_ROOT + '/' + name):
+            response, code = get_objects(Model, where=visible(Model))
+            return response.get_data()
+
+    @staticmethod
+    def compress(body):
+        buffer = StringIO.StringIO()
+        # (A fixed mtime, so the same body always compresses the same)
+        with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as file:
+            file.write(body)
+        return buffer.getvalue()
+
+    def replace(self, name, data):
+        fd, path = tempfile.mkstemp(dir=self.directory, prefix='.' + name)
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.chmod(path, 0o644)
+        os.rename(path, os.path.join(self.directory, name))
+
+    def close(self):
+        # Write anything still waiting out the delay before exiting
+        self.closing = True
+        self.wake.set()
+        self.thread.join()
+        self.write()
+
+snapshots = Snapshots(SNAPSHOT_DIR, SNAPSHOT_DELAY) if SNAPSHOT_DIR else None
+
+@db.event.listens_for(SignallingSession, 'after_commit')
+def snapshot_changes(session):
+    if session.info.pop('changed', None) and snapshots:
+        snapshots.changed()
+
+@app.before_first_request
+def refresh_snapshots():
+    # In case anything changed while no worker was running
+    if snapshots:
+        snapshots.changed()
+
+@db.event.listens_for(SignallingSession, 'after_rollback')
+def forget_changes(session):
+    session.info.pop('changed', None)
 
 
 # OAuth Views                                                                       
@@ -441,15 +1903,29 @@ def authorize(provider):
 class BaseAdmin(AdminIndexView):
     @expose('/')
     def index(self):
+        if not current_user.admin:
+            return self.render('admin/idealab.html', index_page=True, admin=False)
         return self.render('admin/idealab.html', 
             index_page=True,
-            admin=current_user.admin,
-            users=User.query.count(), 
-            ideas=Idea.query.count(), 
-            improvements=Improvement.query.count(),
+            admin=True,
+            stats=stats.snapshot(),
         )
 
-class IdeaAdmin(sqla.ModelView):
+class SearchIndexMixin(object):
+    '''
+    Search the admin list views with the model's full-text index rather than
+    Flask-Admin's LIKE '%term%' across every searchable column
+    '''
+    def _apply_search(self, query, count_query, joins, count_joins, search):
+        if not search.split():
+            return query, count_query, joins, count_joins
+        ids = self.model.search_index.ids(search)
+        query = query.filter(self.model.id.in_(ids))
+        if count_query is not None:
+            count_query = count_query.filter(self.model.id.in_(ids))
+        return query, count_query, joins, count_joins
+
+class IdeaAdmin(SearchIndexMixin, sqla.ModelView):
     def is_accessible(self):
         return current_user.admin
 
@@ -465,6 +1941,7 @@ class IdeaAdmin(sqla.ModelView):
         ),
     }
     column_searchable_list = ('name', 'contact', 'title', 'short_write_up')
+    form_excluded_columns = ('slug', 'version', 'vote_count')
     form_args = {
         'user': {'validators': [required()]},
         'date': {'validators': [required()]},
@@ -482,13 +1959,14 @@ class IdeaAdmin(sqla.ModelView):
         'short_write_up': {'rows': 10},
     }
 
-class ImprovementAdmin(sqla.ModelView):
+class ImprovementAdmin(SearchIndexMixin, sqla.ModelView):
     def is_accessible(self):
         return current_user.admin
 
     action_disallowed_list = ['delete']
     can_create = False
     column_list = ('date', 'published', 'type', 'module', 'content', 'contact')
+    form_excluded_columns = ('version',)
     column_default_sort = ('date', True)
     column_searchable_list = ('module', 'type', 'content', 'contact')
     column_formatters = {
@@ -533,44 +2011,136 @@ admin.add_view(UserAdmin(User, db.session, name="Users"))
 
 # /export 
 # /////////////////////////////////////////////////////////
-def rows_as_csv(rows, fields=None):
-    if fields:
-        rows.insert(0, fields)
+EXPORT_BATCH = 1000
+
+def batches(query, key, size=EXPORT_BATCH):
+    '''
+    Iterate over the rows of a query in batches ordered by key, each batch
+    being a short query of its own so a long export never holds a read
+    transaction open for its whole duration
+    '''
+    last = None
+    while True:
+        rows = (query if last is None else query.filter(key > last))\
+               .order_by(key).limit(size).all()
+        for row in rows:
+            yield row
+        if len(rows) < size:
+            return
+        last = rows[-1].export_key
+
+def rows_as_csv(fields, rows):
+    '''
+    Render rows as CSV, yielding it in chunks suitable for streaming
+    '''
     buffer = StringIO.StringIO()
     writer = csv.writer(buffer, dialect='excel')
+    writer.writerow(fields)
     for row in rows:
         writer.writerow([('%s' % item).encode('utf8') for item in row])
-    buffer.seek(0)
-    return Response(buffer.read(), mimetype='text/csv')
+        if buffer.tell() > 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def export_csv(Model, exports, query=None):
+    '''
+    Stream the published rows of Model as CSV. exports maps each available
+    CSV column to the SQL columns it needs and a function producing its
+    value from a row. ?columns=a,b,c picks and orders the CSV columns and
+    ?since=YYYY-MM-DD limits the export to rows created on or after a date.
+    '''
+    fields = request.args.get('columns', '').split(',') if 'columns' in request.args else exports.keys()
+    if not all(field in exports for field in fields):
+        return status(400)
+    try:
+        since = datetime.datetime.strptime(request.args['since'], '%Y-%m-%d') if 'since' in request.args else None
+    except ValueError:
+        return status(400)
+
+    columns = OrderedDict(export_key=Model.id.label('export_key'))
+    for field in fields:
+        columns.update((column.key, column) for column in exports[field][0])
+    if query is None:
+        query = db.session.query()
+    query = query.add_columns(*columns.values()).filter(Model.published == True)
+    if since:
+        # (Undated rows are only left out when asked for a date)
+        query = query.filter(Model.date >= since)
+    rows = ([exports[field][1](row) for field in fields] for row in batches(query, Model.id))
+    return Response(stream_with_context(rows_as_csv(fields, rows)), mimetype='text/csv')
 
 @app.route('/export/published_ideas.csv', methods=['GET'])
 @admin_required
 def export_published_ideas():
     url = request.url_root + 'idealab/submitted/'
-    rows = []
-    for obj in Idea.query.filter(Idea.published == True):
-        serial = obj.serialized
-        rows.append([obj.name, obj.contact, obj.title, obj.short_write_up, serial['votes'], obj.date, url+serial['slug']])
-    return rows_as_csv(rows, 'name contact title content votes date url'.split())
+    return export_csv(Idea, OrderedDict([
+        ('name',    ([Idea.name],           lambda row: row.name)),
+        ('contact', ([Idea.contact],        lambda row: row.contact)),
+        ('title',   ([Idea.title],          lambda row: row.title)),
+        ('content', ([Idea.short_write_up], lambda row: row.short_write_up)),
+        ('votes',   ([Idea.vote_count],     lambda row: row.vote_count)),
+        ('date',    ([Idea.date],           lambda row: row.date)),
+        ('url',     ([Idea.slug],           lambda row: url + (row.slug or ''))),
+    ]))
 
 @app.route('/export/published_improvements.csv', methods=['GET'])
 @admin_required
 def export_published_improvements():
     url = request.url_root + 'idealab/submitted/'
-    rows = []
-    for obj in Improvement.query.filter(Improvement.published == True):
-        serial = obj.serialized
-        rows.append([serial['username'], obj.contact, obj.module, obj.type, obj.content, obj.link or '', obj.date, url+obj.module])
-    return rows_as_csv(rows, 'name contact module type content link date url'.split())
+    # The user's name and contact keep their own labels so public_name() works on the row
+    user = [User.name.label('name'), User.contact.label('contact')]
+    return export_csv(Improvement, OrderedDict([
+        ('name',    (user,                  lambda row: public_name(row))),
+        ('contact', ([Improvement.contact.label('improvement_contact')],
+                                            lambda row: row.improvement_contact)),
+        ('module',  ([Improvement.module],  lambda row: row.module)),
+        ('type',    ([Improvement.type],    lambda row: row.type)),
+        ('content', ([Improvement.content], lambda row: row.content)),
+        ('link',    ([Improvement.link],    lambda row: row.link or '')),
+        ('date',    ([Improvement.date],    lambda row: row.date)),
+        ('url',     ([Improvement.module],  lambda row: url + row.module)),
+    ]), query=db.session.query().select_from(Improvement).outerjoin(User, User.id==Improvement.user_id))
 
 
 # /ideas 
 # /////////////////////////////////////////////////////////
 @app.route('/ideas', methods=['GET'])
 @app.route('/ideas/<int:id>', methods=['GET'])
+@conditional(Idea)
 def get_ideas(id=None):
-    clause = "(published = '1' OR user_id = '%s')" % current_user.id
-    return get_objects(Idea, id, where=clause)
+    return get_objects(Idea, id, where=visible(Idea))
+
+@app.route('/ideas/top', methods=['GET'])
+@conditional(Idea)
+def top_ideas():
+    '''
+    The ?n= (default 10) most loved published ideas, best first: of all
+    time, or with ?window=day, week or month, trending over loves that
+    lose half their weight each window
+    '''
+    window = request.args.get('window', 'all')
+    try:
+        n = min(int(request.args.get('n', 10)), PAGE_LIMIT)
+    except ValueError:
+        return status(400)
+    if window not in Ranking.windows or n < 1:
+        return status(400)
+    ids = ranking.top(n, window)
+    rows = {row.id: row for row in Idea.serial_query()
+            .filter(Idea.id.in_(ids), Idea.published==True)} if ids else {}
+    return status(200, data=serialize(Idea, [rows[id] for id in ids if id in rows]))
+
+# Titles can hold slashes, and slugify keeps them
+@app.route('/ideas/by-slug/<path:slug>', methods=['GET'])
+@conditional(Idea)
+def get_idea_by_slug(slug):
+    return get_objects(Idea, where=visible(Idea), one=Idea.slug==slug)
+
+@app.route('/ideas/search', methods=['GET'])
+def search_ideas():
+    return search_objects(Idea, where=visible(Idea))
 
 @app.route('/ideas', methods=['POST'])
 def post_idea():
@@ -588,9 +2158,13 @@ def update_idea(id):
 # /////////////////////////////////////////////////////////
 @app.route('/improvements', methods=['GET'])
 @app.route('/improvements/<int:id>', methods=['GET'])
+@conditional(Improvement)
 def get_improvements(id=None):
-    clause = "(published = '1' OR user_id = '%s')" % current_user.id
-    return get_objects(Improvement, id, where=clause)
+    return get_objects(Improvement, id, where=visible(Improvement))
+
+@app.route('/improvements/search', methods=['GET'])
+def search_improvements():
+    return search_objects(Improvement, where=visible(Improvement))
 
 @app.route('/improvements', methods=['POST'])
 def post_improvement():
@@ -614,35 +2188,244 @@ def get_me():
 @app.route('/love/idea/<int:idea_id>', methods=['PUT'])
 @login_required
 def toggle_love(idea_id):
+    if love_queue:
+        if not db.session.query(Idea.id).filter(Idea.id==idea_id).first():
+            return status(404)
+        love_queue.toggle(current_user.id, idea_id)
+        return status(200)
     #TODO: Simplify these queries
     vote = IdeaVote.query.get((current_user.id, idea_id))
     if vote:
-        db.session.delete(vote)
-        db.session.commit()
-        IdeaVote.cache(idea_id)
+        delta = -1
     elif Idea.query.get(idea_id):
-        idea = IdeaVote(current_user.id, idea_id)
-        db.session.add(idea)
-        db.session.commit()
-        IdeaVote.cache(idea_id)
+        delta = +1
     else:
         return status(404)
+    # The denormalized count changes in the same transaction as the vote,
+    # and before it: flushing the vote bumps the version, which the idea's
+    # row must be stamped with (see ChangeVersion.track)
+    Idea.query.filter(Idea.id==idea_id).update(
+        {Idea.vote_count: Idea.vote_count + delta}, synchronize_session=False)
+    if vote:
+        db.session.delete(vote)
+    else:
+        vote = IdeaVote(current_user.id, idea_id)
+        db.session.add(vote)
+    version, _ = ChangeVersion.get(Idea)
+    Event.publish(db.session, vote_events(db.session, [idea_id]))
+    changes = [(idea_id, delta, vote.date)]
+    db.session.commit()
+    ranking.update(version, changes)
     return status(200)
 
+@app.route('/love/reconcile', methods=['GET', 'POST'])
+@admin_required
+def reconcile_love():
+    # Report (and when POSTed to, fix) any drift between idea.vote_count
+    # and the idea_vote table
+    drift = IdeaVote.reconcile(repair=request.method == 'POST')
+    return status(200, data=[{'id': id, 'stored': stored, 'actual': actual}
+                             for id, stored, actual in drift])
+
+
+# /stats
+# /////////////////////////////////////////////////////////
+@app.route('/stats', methods=['GET'])
+@admin_required
+def get_stats():
+    return status(200, data=stats.snapshot())
+
+
+# /metrics
+# /////////////////////////////////////////////////////////
+@app.route('/metrics', methods=['GET'])
+@admin_required
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# /events
+# /////////////////////////////////////////////////////////
+@app.route('/events', methods=['GET'])
+def get_events():
+    '''
+    Server-sent events of public changes: {"type": "votes", "id", "votes"}
+    when an idea's loves change, {"type": "idea", "id", "idea"} with the
+    idea as anonymous viewers get it when one is published or edited, and
+    {"type": "removed", "id"} when one is unpublished or deleted, or
+    {"type": "reset"} when the client should refetch everything (events
+    were missed, or import.py changed ideas wholesale).
+    '''
+    event_hub.start()
+    try:
+        last = int(request.headers.get('Last-Event-ID', event_hub.last))
+    except ValueError:
+        return status(400)
+    response = Response(event_stream(last), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Don't let nginx hold events back in its buffers
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 
 # Generic RESTfulness
 # /////////////////////////////////////////////////////////
-def get_objects(Model, id=None, where=''):
+PAGE_LIMIT = 100
+
+def visible(Model):
+    '''
+    The rows current_user may see: everything published plus their own.
+    Anonymous users only get the published branch, which can be answered
+    (and ordered by date) from the (published, date) index alone; otherwise
+    SQLite resolves the OR with one index lookup per branch.
     '''
-    GET the collection or single objects
+    if current_user.id == -1:
+        return Model.published == True
+    return db.or_(Model.published == True, Model.user_id == current_user.id)
+
+def encode_cursor(value, id):
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([value, id])).rstrip('=')
+
+def decode_cursor(cursor, sort):
+    cursor = str(cursor)
+    value, id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    if sort == 'date':
+        fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S'
+        value = datetime.datetime.strptime(value, fmt)
+    return value, int(id)
+
+def sort_column(Model, query, sort):
     '''
+    Return the query, joined as necessary, and the expression to sort it by
+    '''
+    if sort == 'date':
+        return query, Model.date
+    if sort == 'votes' and Model is Idea:
+        return query, Idea.vote_count
+    raise ValueError(sort)
+
+def paginate(Model, query):
+    '''
+    Apply the ?sort=, ?limit= and ?after= arguments to a serial_query().
+    Pages are keyed on (sort value, id) rather than an OFFSET, so deep pages
+    cost the same as the first one. Returns the page of rows and the cursor
+    for the next page (None on the last one).
+    '''
+    sort = request.args.get('sort', 'date')
+    descending = sort.startswith('-')
+    sort = sort.lstrip('-')
+    limit = min(int(request.args.get('limit', PAGE_LIMIT)), PAGE_LIMIT)
+    if limit < 1:
+        raise ValueError(limit)
+
+    query, column = sort_column(Model, query, sort)
+    if request.args.get('after'):
+        value, id = decode_cursor(request.args['after'], sort)
+        if descending:
+            query = query.filter(db.or_(column < value, db.and_(column == value, Model.id < id)))
+        else:
+            query = query.filter(db.or_(column > value, db.and_(column == value, Model.id > id)))
+    order = (column.desc(), Model.id.desc()) if descending else (column, Model.id)
+    rows = query.add_columns(column.label('sort_key')).order_by(*order).limit(limit + 1).all()
+
+    cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        cursor = encode_cursor(rows[-1].sort_key, rows[-1].id)
+    return rows, cursor
+
+@timed('serialize')
+def serialize(Model, rows, fields=None, compact=False):
+    '''
+    Serialize rows of Model.serial_query(fields) as dicts, or with compact
+    as arrays in the order of fields. Like the serialized properties, a row
+    which can't be serialized gives {} (or null).
+    '''
+    makers = [(field, Model.serial_fields[field][1]) for field in fields or Model.serial_fields]
+    serials = []
+    for row in rows:
+        try:
+            if compact:
+                serials.append([make(row) for field, make in makers])
+            else:
+                serials.append({field: make(row) for field, make in makers})
+        except (AttributeError, TypeError, ValueError):
+            serials.append(None if compact else {})
+    return serials
+
+def get_objects(Model, id=None, where='', one=None):
+    '''
+    GET the collection or single objects (by id, or whichever matches the
+    condition one), serialized straight from the columns they need rather
+    than from loaded objects. ?fields=a,b,c picks the fields sent (and so
+    the columns read), and ?compact=1 sends each object of a collection as
+    an array of them, with their names listed once in "fields".
+    Collections come with the "version" they're as of. Given that back as
+    ?since=, only the objects written since are sent, with the ids of those
+    since deleted or hidden from current_user in "deleted" (which clients
+    should drop before adding "data").
+    '''
+    fields = request.args['fields'].split(',') if 'fields' in request.args else None
+    if fields and not all(field in Model.serial_fields for field in fields):
+        return status(400)
+    query = Model.serial_query(fields).filter(where)
     if id:
-        obj = Model.query.filter(Model.id==id, where).first()
-        if not obj:
+        one = Model.id==id
+    if one is not None:
+        row = query.filter(one).first()
+        if not row:
             return status(404)
-        return status(200, data=obj.serialized)
-    objs = Model.query.filter(where).all()
-    return status(200, data=[obj.serialized for obj in objs])
+        return status(200, data=serialize(Model, [row], fields)[0])
+    # (Read first, so nothing written while the rows are read gets missed)
+    kw = {'version': ChangeVersion.get(Model)[0]}
+    if 'since' in request.args:
+        try:
+            since = int(request.args['since'])
+        except ValueError:
+            return status(400)
+        changed = Model.version > since
+        pending = love_queue.toggles(current_user.id) if love_queue and Model is Idea else {}
+        if pending:
+            # Toggles not yet written show in their owner's view but not in versions
+            changed = db.or_(changed, Idea.id.in_(list(pending)))
+        rows = query.filter(changed).all()
+        changed = {id for id, in db.session.query(Model.id).filter(changed)}
+        deleted = {id for id, in db.session.query(Tombstone.id).filter(
+            Tombstone.name==unicode(Model.__tablename__), Tombstone.version > since)}
+        kw['deleted'] = sorted(deleted | changed - {row.id for row in rows})
+    elif not any(arg in request.args for arg in ('sort', 'limit', 'after')):
+        # Unpaginated requests get the whole collection as they always have
+        rows = query.all()
+    else:
+        try:
+            rows, kw['next'] = paginate(Model, query)
+        except (TypeError, ValueError):
+            return status(400)
+    compact = bool(request.args.get('compact'))
+    if compact:
+        kw['fields'] = fields or Model.serial_fields.keys()
+    return status(200, data=serialize(Model, rows, fields, compact), **kw)
+
+def search_objects(Model, where=''):
+    '''
+    GET the objects matching ?q=, best match first, each with a "snippet"
+    of HTML-escaped matching text in which matched terms are <mark>ed
+    '''
+    q = request.args.get('q', '')
+    if not q.split():
+        return status(400)
+    try:
+        limit = min(int(request.args.get('limit', PAGE_LIMIT)), PAGE_LIMIT)
+    except ValueError:
+        return status(400)
+    data = []
+    for obj, snippet in Model.search_index.search(q, where, limit):
+        serial = obj.serialized
+        serial['snippet'] = unicode(escape(snippet or u'')).replace(u'\x02', u'<mark>').replace(u'\x03', u'</mark>')
+        data.append(serial)
+    return status(200, data=data)
 
 def post_object(Model):
     '''
@@ -683,6 +2466,27 @@ def update_object(Model, id):
     return status(500)
 
 
+# Commands
+# ////////////////////////////////////////////////////////////////////////////
+@app.cli.command()
+def rebuild_search():
+    '''
+    Rebuild the full-text search indexes from their tables
+    '''
+    Idea.search_index.rebuild()
+    Improvement.search_index.rebuild()
+
+@app.cli.command()
+def snapshot():
+    '''
+    Rewrite the static snapshots of the published collections, as after
+    running import.py
+    '''
+    if not snapshots:
+        sys.exit('Set SNAPSHOT_DIR in config.py first')
+    snapshots.write(force=True)
+
+
 # Run server when executed as a script                                                                 
 # ////////////////////////////////////////////////////////////////////////////
 if __name__ == '__main__':
@@ -1,15 +1,36 @@
 #!/usr/bin/env python2
+'''
+Re-sync ideas from the moderation spreadsheet. Usage:
 
+    ./import.py              # download the sheet from CSV_URL
+    ./import.py sheet.csv    # read a local export
+    ./import.py -            # read CSV from stdin
+    ./import.py --owner ID   # also insert rows the database doesn't have
+
+Rows are compared with the database by a hash of (published, title,
+short_write_up), and only new or changed rows are written, all in one
+short transaction at the end. New and retitled ideas get unique slugs just
+as the API would give them.
+
+The sheet doesn't say who wrote an idea, so rows missing from the database
+are skipped unless --owner names the user to give them to. Ideas deleted
+through the API are always skipped rather than brought back.
+'''
+
+import argparse
 import contextlib
 import csv
+import datetime
+import hashlib
+import itertools
 import os, os.path
-import shutil
-import time
+import sys
 import urllib2
 try:
     import sqlite3
 except ImportError:
     from pysqlite2 import dbapi2 as sqlite3
+import backup
 
 THIS_DIR = os.path.dirname(os.path.realpath(__file__))
 DB_FILE = 'idealab.db'
@@ -18,31 +39,119 @@ DOC_ID = '1EJRqTOjDbwV6iNf9tfL2Rz7g8OrDaiYvxLFc1ar1598'
 CSV_URL = 'https://docs.google.com/spreadsheets/d/{}/export?format=csv'.format(DOC_ID)
 
 def backup_db(path=THIS_DIR + '/backups'):
-    try:
-        os.mkdir(path)
-    except OSError: pass
-    shutil.copy(DB_PATH, '%s/%s.%s' % (path, DB_FILE, time.strftime('%F@%R')))
+    return backup.backup(path)
 
 def utf8izer(reader):
     for line in reader:
         yield [col.decode('utf8') for col in line]
 
-def main():
-    backup_db()
+@contextlib.contextmanager
+def open_csv(source=None):
+    if source == '-':
+        yield sys.stdin
+    elif source:
+        with open(source, 'rb') as file:
+            yield file
+    else:
+        with contextlib.closing(urllib2.urlopen(CSV_URL)) as file:
+            yield file
+
+def row_hash(published, title, short_write_up):
+    return hashlib.sha1(u'\0'.join((published, title, short_write_up)).encode('utf8')).digest()
+
+def current_hashes(c):
+    return {id: row_hash('1' if published else '0', title or u'', short_write_up or u'')
+            for id,published,title,short_write_up
+            in c.execute('SELECT id,published,title,short_write_up FROM idea')}
+
+def slugify(title):
+    # As idealab.slugify
+    return title.lower().replace(' ', '-').replace('&#8217', '-')
 
+def unique_slug(title, id, slugs):
+    '''
+    As idealab.unique_slug, given slugs mapping every slug in use to its
+    idea's id, which is updated with the result
+    '''
+    slug = slugify(title)
+    for n in itertools.count(2):
+        if slugs.get(slug, id) == id:
+            slugs[slug] = id
+            return slug
+        slug = u'%s-%d' % (slugify(title), n)
+
+def deleted_ids(c):
+    return {id for id, in c.execute("SELECT id FROM tombstone WHERE name='idea'")}
+
+def diff(rows, hashes, deleted, insert=True):
+    '''
+    Sort the spreadsheet's rows into those to insert (if insert) and those
+    to update, counting the ones that are unchanged or unusable (such as the
+    header, or ideas in deleted)
+    '''
+    inserts, updates, unchanged, skipped = [], [], 0, 0
+    for id,published,name,contact,title,short_write_up in rows:
+        published = '1' if published == '1' else '0'
+        if not id.isdigit():
+            skipped += 1
+        elif int(id) not in hashes:
+            if insert and int(id) not in deleted:
+                inserts.append((id, published, name, contact, title, short_write_up))
+            else:
+                skipped += 1
+        elif hashes[int(id)] != row_hash(published, title, short_write_up):
+            updates.append((published, title, short_write_up, id))
+        else:
+            unchanged += 1
+    return inserts, updates, unchanged, skipped
+
+def main(source=None, owner=None):
     db = sqlite3.connect(DB_PATH)
     c = db.cursor()
-    with contextlib.closing(urllib2.urlopen(CSV_URL)) as file:
-        for id,published,name,contact,title,short_write_up in utf8izer(csv.reader(file)):
-            published = '1' if published == '1' else '0'
-            c.execute('''
-                UPDATE idea 
-                SET published=?,title=?,short_write_up=? 
-                WHERE id=?
-            ''', (published, title, short_write_up, id))
-    db.commit()
+    if owner is not None and not c.execute('SELECT 1 FROM user WHERE id=?', (owner,)).fetchone():
+        sys.exit('No user %d to own new ideas' % owner)
+    with open_csv(source) as file:
+        inserts, updates, unchanged, skipped = diff(utf8izer(csv.reader(file)), current_hashes(c),
+                                                    deleted_ids(c), insert=owner is not None)
+
+    if inserts or updates:
+        backup_db()
+        now = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
+        c.execute('BEGIN IMMEDIATE')
+        titles = dict(c.execute('SELECT id,title FROM idea'))
+        retitled = {int(id) for published,title,short_write_up,id in updates if title != titles[int(id)]}
+        # Retitled ideas give up their old slugs before anything takes new ones
+        slugs = {slug: id for slug,id in c.execute('SELECT slug,id FROM idea WHERE slug IS NOT NULL')
+                 if id not in retitled}
+        c.executemany('UPDATE idea SET slug=NULL WHERE id=?', [(id,) for id in retitled])
+        c.executemany('''
+            UPDATE idea
+            SET published=?,title=?,short_write_up=?,slug=COALESCE(?,slug)
+            WHERE id=?
+        ''', [row[:3] + (unique_slug(row[1], int(row[3]), slugs) if int(row[3]) in retitled else None,
+                         row[3]) for row in updates])
+        c.executemany('''
+            INSERT INTO idea (id,user_id,date,published,solution,vote_count,name,contact,title,short_write_up,slug)
+            VALUES (?,?,?,?,0,0,?,?,?,?,?)
+        ''', [(row[0], owner, now) + row[1:] + (unique_slug(row[4], int(row[0]), slugs),) for row in inserts])
+        # Let the API know the idea collection changed underneath it (last,
+        # as the rows written were stamped with the version this makes)
+        c.execute('''
+            UPDATE change_version
+            SET version=version+1,modified=?
+            WHERE name='idea'
+        ''', (now,))
+        # ...and tell /events listeners to refetch them
+        c.execute('INSERT INTO event (data) VALUES (?)', ('{"type": "reset"}',))
+        db.commit()
     db.close()
+    print('%d inserted, %d updated, %d unchanged, %d skipped' % (
+        len(inserts), len(updates), unchanged, skipped))
 
 if __name__ == '__main__':
-    main()
-
+    parser = argparse.ArgumentParser(description='Re-sync ideas from the moderation spreadsheet')
+    parser.add_argument('source', nargs='?', help='a CSV export, or - for stdin (default: download CSV_URL)')
+    parser.add_argument('--owner', type=int, metavar='ID',
+                        help='insert rows missing from the database as ideas of this user')
+    args = parser.parse_args()
+    main(args.source, args.owner)
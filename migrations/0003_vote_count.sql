@@ -0,0 +1,3 @@
+-- Denormalize the number of votes for each idea onto the idea itself
+ALTER TABLE idea ADD COLUMN vote_count INTEGER DEFAULT '0' NOT NULL;
+UPDATE idea SET vote_count=(SELECT COUNT(*) FROM idea_vote WHERE idea_vote.idea_id=idea.id);
@@ -0,0 +1,40 @@
+#!/bin/bash
+main () {
+#############################################################################
+
+compare Votes\
+    'SELECT idea.id,COUNT(idea_vote.user_id) FROM idea LEFT JOIN idea_vote ON idea_vote.idea_id=idea.id GROUP BY idea.id;' \
+    'SELECT id,vote_count FROM idea;'
+
+compare Ideas\
+    'SELECT id,published,title,short_write_up FROM idea;' \
+    'SELECT id,published,title,short_write_up FROM idea;'
+
+#############################################################################
+}
+compare () {
+    # USAGE: compare NAME OLD_QUERY NEW_QUERY 
+    echo "$2"|sqlite3 before.db >before
+    echo "$3"|sqlite3 after.db >after
+    diff -u before after >/dev/null && echo -e "\033[32m$1 OK\033[0m" || echo -e "\033[31m$1 FAILED\033[0m"
+}
+cd $(dirname $(readlink -f $0))
+BASE=$(basename -s .test.sh $0)
+echo "Testing ${BASE}..."
+BEFORE=${BASE}.before
+AFTER=${BASE}.after
+if file $BEFORE|grep SQL 2>/dev/null; then
+    # These are already sqlite dbs
+    cp $BEFORE before.db
+    cp $AFTER after.db
+else
+    # These are SQL dumps
+    sqlite3 before.db ".read $BEFORE"
+    sqlite3 after.db ".read $AFTER"
+fi
+sqlite3 before.db ".schema" >before
+sqlite3 after.db ".schema" >after
+echo -e "\033[33mSchema diff\033[0m" 
+diff -u before after
+main
+rm before.db after.db before after
@@ -0,0 +1,13 @@
+-- Indexes for the hot read paths: visibility filters and date ordering on
+-- ideas and improvements, OAuth and Google Forms user lookups, and votes
+-- grouped by idea
+CREATE INDEX IF NOT EXISTS ix_user_local_id ON user (local_id);
+CREATE INDEX IF NOT EXISTS ix_user_contact ON user (contact);
+CREATE INDEX IF NOT EXISTS ix_idea_user_id ON idea (user_id);
+CREATE INDEX IF NOT EXISTS ix_idea_date ON idea (date);
+CREATE INDEX IF NOT EXISTS ix_idea_published_date ON idea (published, date);
+CREATE INDEX IF NOT EXISTS ix_idea_published_vote_count ON idea (published, vote_count);
+CREATE INDEX IF NOT EXISTS ix_idea_vote_idea_id ON idea_vote (idea_id);
+CREATE INDEX IF NOT EXISTS ix_improvement_user_id ON improvement (user_id);
+CREATE INDEX IF NOT EXISTS ix_improvement_date ON improvement (date);
+CREATE INDEX IF NOT EXISTS ix_improvement_published_date ON improvement (published, date);
@@ -0,0 +1,76 @@
+#!/bin/bash
+main () {
+#############################################################################
+
+compare Ideas\
+    'SELECT id,user_id,date,published,title FROM idea;' \
+    'SELECT id,user_id,date,published,title FROM idea;'
+
+compare Users\
+    'SELECT id,local_id,contact FROM user;' \
+    'SELECT id,local_id,contact FROM user;'
+
+plan 'Published ideas by date'\
+    "SELECT * FROM idea WHERE published = 1 ORDER BY date, id LIMIT 10;" \
+    'ix_idea_published_date'
+
+plan 'Visible ideas (published branch)'\
+    "SELECT * FROM idea WHERE published = 1 OR user_id = 1;" \
+    'ix_idea_published_[a-z_]*'
+
+plan 'Visible ideas (user branch)'\
+    "SELECT * FROM idea WHERE published = 1 OR user_id = 1;" \
+    'ix_idea_user_id'
+
+plan 'Visible improvements'\
+    "SELECT * FROM improvement WHERE published = 1 OR user_id = 1;" \
+    'ix_improvement_user_id'
+
+plan 'Most loved ideas'\
+    "SELECT * FROM idea WHERE published = 1 ORDER BY vote_count DESC, id DESC LIMIT 10;" \
+    'ix_idea_published_vote_count'
+
+plan 'OAuth user lookup'\
+    "SELECT * FROM user WHERE local_id = 'x';" \
+    'ix_user_local_id'
+
+plan 'Google Forms user lookup'\
+    "SELECT * FROM user WHERE contact = 'x';" \
+    'ix_user_contact'
+
+plan 'Votes by idea'\
+    'SELECT idea_id,COUNT(user_id) FROM idea_vote GROUP BY idea_id;' \
+    'ix_idea_vote_idea_id'
+
+#############################################################################
+}
+compare () {
+    # USAGE: compare NAME OLD_QUERY NEW_QUERY 
+    echo "$2"|sqlite3 before.db >before
+    echo "$3"|sqlite3 after.db >after
+    diff -u before after >/dev/null && echo -e "\033[32m$1 OK\033[0m" || echo -e "\033[31m$1 FAILED\033[0m"
+}
+plan () {
+    # USAGE: plan NAME QUERY INDEX
+    echo "EXPLAIN QUERY PLAN $2"|sqlite3 after.db|grep -q "INDEX $3\b" && echo -e "\033[32m$1 OK\033[0m" || echo -e "\033[31m$1 FAILED\033[0m"
+}
+cd $(dirname $(readlink -f $0))
+BASE=$(basename -s .test.sh $0)
+echo "Testing ${BASE}..."
+BEFORE=${BASE}.before
+AFTER=${BASE}.after
+if file $BEFORE|grep SQL 2>/dev/null; then
+    # These are already sqlite dbs
+    cp $BEFORE before.db
+    cp $AFTER after.db
+else
+    # These are SQL dumps
+    sqlite3 before.db ".read $BEFORE"
+    sqlite3 after.db ".read $AFTER"
+fi
+sqlite3 before.db ".schema" >before
+sqlite3 after.db ".schema" >after
+echo -e "\033[33mSchema diff\033[0m" 
+diff -u before after
+main
+rm before.db after.db before after
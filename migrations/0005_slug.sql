@@ -0,0 +1,5 @@
+-- Store each idea's slug, unique and indexed for /ideas/by-slug/<slug>.
+-- The API slugs the existing ideas in Python when it next starts (SQLite's
+-- lower() only knows ASCII), numbering any duplicates -2, -3...
+ALTER TABLE idea ADD COLUMN slug VARCHAR(500);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_idea_slug ON idea (slug);
@@ -0,0 +1,5 @@
+-- Date each love, for trending ideas (/ideas/top?window=) and loves per day.
+-- Loves from before this have no date: they count towards the all-time
+-- ranking and vote counts only.
+ALTER TABLE idea_vote ADD COLUMN date DATETIME;
+CREATE INDEX IF NOT EXISTS ix_idea_vote_date ON idea_vote (date);
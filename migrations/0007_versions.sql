@@ -0,0 +1,8 @@
+-- Stamp ideas and improvements with the collection version of their last
+-- write, for ?since= syncing. The API creates the tombstone table and the
+-- triggers that keep these current when it next starts; until something
+-- writes to them, existing rows are as of version 0.
+ALTER TABLE idea ADD COLUMN version INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE improvement ADD COLUMN version INTEGER NOT NULL DEFAULT 0;
+CREATE INDEX IF NOT EXISTS ix_idea_version ON idea (version);
+CREATE INDEX IF NOT EXISTS ix_improvement_version ON improvement (version);